@@ -1,5 +1,6 @@
 import calendar
 from datetime import date, timedelta
+from functools import lru_cache
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.callback_data import CallbackData
@@ -7,56 +8,84 @@ from aiogram.utils.callback_data import CallbackData
 # setting callback_data prefix and parts
 calendar_callback = CallbackData('calendar', 'act', 'year', 'month', 'day')
 
+# amount of rendered months kept, a couple of years of paging back and forth;
+# the bookings are laid over the cached buttons, so the months are shared by every household
+CALENDAR_CACHE_SIZE = 32
+BOOKED_DAY_TEXT = '🎉'
+_cache_day = None
 
-def create_calendar(year=date.today().year, month=date.today().month):
+
+def create_calendar(year=None, month=None, booked=0):
     """
     Creates an inline keyboard with the provided year and month
     :param int year: Year to use in the calendar, if None the current year is used.
     :param int month: Month to use in the calendar, if None the current month is used.
-    :return: Returns InlineKeyboardMarkup object with the calendar.
+    :param int booked: Bitmap of booked days, bit N is set if day N is booked. Booked days can not be selected.
+    :return: Returns InlineKeyboardMarkup object with the calendar, its buttons are shared between calls
+        so they must not be changed.
     """
+    global _cache_day
     today = date.today()
+    # past days are rendered as blanks, so every keyboard rendered yesterday is stale
+    if today != _cache_day:
+        _month_layout.cache_clear()
+        _cache_day = today
+    return _build_calendar(_month_layout(year or today.year, month or today.month, today), booked)
+
 
-    inline_kb = InlineKeyboardMarkup(row_width=7)
+@lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _month_layout(year, month, today):
+    """
+    Buttons of the month that don't depend on the bookings.
+    :return: Returns tuple of the rows above the days, the weeks as lists of (day, button) with day 0 for blanks,
+        the row below the days and the button of a booked day.
+    """
     ignore_callback = calendar_callback.new('IGNORE', year, month, 0)  # for buttons with no answer
     # First row - Month and Year
-    inline_kb.row()
+    title = []
     if year > today.year or month > today.month:
-        inline_kb.insert(InlineKeyboardButton('<', callback_data=calendar_callback.new('PREV-MONTH', year, month, 0)))
-    inline_kb.insert(InlineKeyboardButton(f'{calendar.month_name[month]} {str(year)}', callback_data=ignore_callback))
-    inline_kb.insert(InlineKeyboardButton('>', callback_data=calendar_callback.new('NEXT-MONTH', year, month, 0)))
+        title.append(InlineKeyboardButton('<', callback_data=calendar_callback.new('PREV-MONTH', year, month, 0)))
+    title.append(InlineKeyboardButton(f'{calendar.month_name[month]} {str(year)}', callback_data=ignore_callback))
+    title.append(InlineKeyboardButton('>', callback_data=calendar_callback.new('NEXT-MONTH', year, month, 0)))
     # Second row - Week Days
-    inline_kb.row()
-    for day in ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su']:
-        inline_kb.insert(InlineKeyboardButton(day, callback_data=ignore_callback))
+    week_days = [
+        InlineKeyboardButton(day, callback_data=ignore_callback) for day in ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su']
+    ]
 
     # Calendar rows - Days of month
-    month_calendar = calendar.monthcalendar(year, month)
-    for week in month_calendar:
-        inline_kb.row()
-        for day in week:
-            if not day or (year == today.year and month == today.month and day < today.day):
-                inline_kb.insert(
-                    InlineKeyboardButton(' ', callback_data=ignore_callback)
-                )
-            else:
-                inline_kb.insert(
-                    InlineKeyboardButton(str(day), callback_data=calendar_callback.new('DAY', year, month, day))
-                )
-    inline_kb.row()
-    inline_kb.insert(InlineKeyboardButton(
-        'Отменить выбор', callback_data=calendar_callback.new('ROLLBACK', year, month, 0))
-    )
-
-    return inline_kb
-
-
-async def process_calendar_selection(query, data):
+    blank = InlineKeyboardButton(' ', callback_data=ignore_callback)
+    weeks = []
+    for week in calendar.monthcalendar(year, month):
+        weeks.append([
+            (0, blank) if not day or (year == today.year and month == today.month and day < today.day)
+            else (day, InlineKeyboardButton(str(day), callback_data=calendar_callback.new('DAY', year, month, day)))
+            for day in week
+        ])
+    rollback = [InlineKeyboardButton(
+        'Отменить выбор', callback_data=calendar_callback.new('ROLLBACK', year, month, 0)
+    )]
+
+    return [title, week_days], weeks, rollback, InlineKeyboardButton(BOOKED_DAY_TEXT, callback_data=ignore_callback)
+
+
+def _build_calendar(layout, booked=0):
+    header, weeks, footer, booked_button = layout
+    days = [[booked_button if booked >> day & 1 else button for day, button in week] for week in weeks]
+    return InlineKeyboardMarkup(row_width=7, inline_keyboard=[*header, *days, footer])
+
+
+def _paged_calendar(month_date, occupancy):
+    booked = occupancy(month_date.year, month_date.month) if occupancy else 0
+    return create_calendar(int(month_date.year), int(month_date.month), booked)
+
+
+async def process_calendar_selection(query, data, occupancy=None):
     """
     Process the callback_query. This method generates a new calendar if forward or
     backward is pressed. This method should be called inside a CallbackQueryHandler.
     :param query: callback_query, as provided by the CallbackQueryHandler
     :param data: callback_data, dictionary, set by calendar_callback
+    :param occupancy: function getting year and month and returning the booked days bitmap for the new calendar
     :return: Returns a tuple (Boolean,datetime), indicating if a date is selected
                 and returning the date if so.
     """
@@ -75,11 +104,11 @@ async def process_calendar_selection(query, data):
     # user navigates to previous month, editing message with new calendar
     elif data['act'] == 'PREV-MONTH':
         prev_date = temp_date - timedelta(days=1)
-        await query.message.edit_reply_markup(create_calendar(int(prev_date.year), int(prev_date.month)))
+        await query.message.edit_reply_markup(_paged_calendar(prev_date, occupancy))
     # user navigates to next month, editing message with new calendar
     elif data['act'] == 'NEXT-MONTH':
         next_date = temp_date + timedelta(days=31)
-        await query.message.edit_reply_markup(create_calendar(int(next_date.year), int(next_date.month)))
+        await query.message.edit_reply_markup(_paged_calendar(next_date, occupancy))
     else:
         await query.message.answer('Something went wrong!')
 
@@ -1,16 +1,36 @@
 from aiogram.utils import executor
+from aiohttp import web
 
 from config import settings
-from moon_house_bot.app import dp, on_shutdown, on_startup
+from moon_house_bot.app import dp, front_shutdown, front_startup, on_shutdown, on_startup
+from moon_house_bot.metrics import metrics_handler
+from moon_house_bot.workers import run_workers
 
 if __name__ == '__main__':
     print(f'{settings.webhook.host}{settings.webhook.path}')
-    executor.start_webhook(
-        dispatcher=dp,
-        webhook_path=settings.webhook.path,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown,
-        skip_updates=True,
-        host=settings.host,
-        port=settings.port,
-    )
+    if settings.workers.amount > 1:
+        run_workers(
+            workers=settings.workers.amount,
+            concurrency=settings.workers.concurrency,
+            path=settings.webhook.path,
+            host=settings.host,
+            port=settings.port,
+            on_startup=front_startup,
+            on_shutdown=front_shutdown,
+            dedup_size=settings.update_dedup.max_size,
+            metrics_path=settings.metrics.path,
+        )
+    else:
+        # metrics are served by the same aiohttp app as the webhook
+        web_app = web.Application()
+        web_app.router.add_get(settings.metrics.path, metrics_handler)
+        webhook_executor = executor.set_webhook(
+            dispatcher=dp,
+            webhook_path=settings.webhook.path,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            # pending updates are handled by the catch up in on_startup or dropped with the webhook
+            skip_updates=False,
+            web_app=web_app,
+        )
+        webhook_executor.run_app(host=settings.host, port=settings.port)
@@ -1,23 +1,100 @@
+import asyncio
 import logging
+import time
 from datetime import date, datetime, timedelta
 from distutils.util import strtobool
+from functools import partial, wraps
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils.callback_data import CallbackData
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from sqlalchemy import Date, and_, case, text
+from asyncpg import UniqueViolationError
+from sqlalchemy import and_, case, text
+from sqlalchemy.dialects.postgresql import insert
 
 from aiogramcalendar import calendar_callback, create_calendar, process_calendar_selection
 from config import settings
-from moon_house_bot.database import Notification, Party, User, db
-
-bot = Bot(token=settings.token)
-dp = Dispatcher(bot, storage=MemoryStorage())
-scheduler = AsyncIOScheduler()
+from moon_house_bot.appliances import LOAD, UNLOAD, ApplianceCycles
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.counters import ActivityCounters
+from moon_house_bot.database import (
+    ActivityRollup,
+    InstrumentedPool,
+    NotificationBuffer,
+    Party,
+    User,
+    archive_notifications,
+    db,
+    get_database_url,
+    instrument_engine,
+    migrate,
+    pool_stats,
+    query_stats,
+    warm_up_pool,
+)
+from moon_house_bot.dedup import DeduplicationMiddleware, RecentUpdates
+from moon_house_bot.export import FORMATS, HistoryExport
+from moon_house_bot.fsm_storage import PostgresStorage
+from moon_house_bot.households import Households
+from moon_house_bot.instrumentation import (
+    InstrumentedBot,
+    instrument_dispatcher,
+    instrument_scheduler,
+    refresh_fsm_states,
+)
+from moon_house_bot.leader import LeaderLock
+from moon_house_bot.lifecycle import InFlightMiddleware, fetch_pending_updates
+from moon_house_bot.members import MemberCache
+from moon_house_bot.metrics import serve_metrics, stats_gauge
+from moon_house_bot.outbound import OutboundDispatcher
+from moon_house_bot.parties import PartyIndex, UpcomingParty
+from moon_house_bot.throttling import ThrottlingMiddleware, coalesce
+from moon_house_bot.tracing import UpdateTracer
+from moon_house_bot.workers import OrderedProcessor, update_routing_key
+
+bot = InstrumentedBot(token=settings.token)
+dp = Dispatcher(bot, storage=PostgresStorage(**settings.fsm_storage))
+# timers and cron jobs survive restarts in Postgres, in-memory default store is for process-bound jobs
+scheduler = AsyncIOScheduler(
+    jobstores={'durable': SQLAlchemyJobStore(url=get_database_url(), tablename='scheduled_jobs')},
+    job_defaults={'coalesce': True},
+)
+# every worker sends on its own, the front process only dispatches updates to them
+outbound = OutboundDispatcher(bot, processes=settings.workers.amount, **settings.outbound)
+notifications = NotificationBuffer(**settings.notification_buffer)
+# in-memory state is shared with the other worker processes, if there are any
+broadcast = Broadcast(enabled=settings.workers.amount > 1)
+members = MemberCache(broadcast, **settings.members_cache)
+households = Households(broadcast)
+appliances = ApplianceCycles(settings.appliances, broadcast)
+parties = PartyIndex(broadcast)
+activity_counters = ActivityCounters(settings.activity_windows, broadcast)
+# arbitrary advisory lock key, only the process holding it runs the daily jobs
+scheduler_leader = LeaderLock(key=4_617_002)
+tracer = UpdateTracer(**settings.tracing)
+history_export = HistoryExport(outbound, **settings.history_export)
+
+instrument_scheduler(scheduler)
+stats_gauge('bot_outbound', 'Outbound dispatcher queue and delivery stats', lambda: outbound.stats)
+stats_gauge('bot_db_pool', 'DB connection pool checkout stats', lambda: pool_stats.stats)
+stats_gauge('bot_members_cache', 'Members cache size, hits and misses', lambda: members.stats)
+
+
+def is_overloaded():
+    # a short wait for a DB connection is normal load, the pool is saturated once more callers wait
+    # than pool_waiting_ratio of its connections; or the Bot API calls pile up faster than they go out
+    return pool_stats.waiting > settings.load_shedding.pool_waiting_ratio * settings.database_pool.max_size \
+        or outbound.queue_depth >= settings.load_shedding.outbound_queue
+
+
+dp.middleware.setup(DeduplicationMiddleware(RecentUpdates(**settings.update_dedup)))
+dp.middleware.setup(ThrottlingMiddleware(**settings.throttling, overloaded=is_overloaded))
+in_flight = InFlightMiddleware()
+dp.middleware.setup(in_flight)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,25 +102,39 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+GROUP_CHAT_TYPES = ('group', 'supergroup')
+
+
 def chat_checker(login_required: bool = True):
     def decorator(func):
 
+        @wraps(func)
         async def wrapper(message):
-            if message.chat.type == 'private' or message.chat.id == settings.target_chat_id:
-                user = await User.query.where(and_(
-                    User.chat_id == message.from_user.id,
-                    User.deleted.is_(None)
-                )).gino.first()
-                if not login_required:
+            # any group can become a household, so the menu is open to groups, the rest works in private only
+            if message.chat.type == 'private' or not login_required:
+                user = await members.get(message.from_user.id)
+                if user or not login_required:
                     return await func(message, user)
-                elif user and message.chat.type == 'private':
-                    return await func(message)
 
         return wrapper
 
     return decorator
 
 
+def member_required(func):
+    """
+    Lets through updates of members only, the handler gets the member as user after the update.
+    """
+    # aiogram unwraps the handler, so only the arguments func asks for are passed
+    @wraps(func)
+    async def wrapper(update, **kwargs):
+        user = await members.get(update.from_user.id)
+        if user:
+            return await func(update, user, **kwargs)
+
+    return wrapper
+
+
 class PlanParty(StatesGroup):
     party_date = State()
     guests_amount = State()
@@ -64,34 +155,43 @@ party_manage_data = CallbackData('party_manage', 'id', 'using_sofa')
 party_edit_data = CallbackData('party_edit', 'edit_type', 'id')
 sofa_using_edit_data = CallbackData('sofa_using_edit', 'using', 'id')
 
-DISHWASHER_TIME_LOADING = 4
+PARTY_GONE_MESSAGE = 'Эта тусовка уже прошла или отменена'
 
 
 @dp.message_handler(commands=['start', 'home'])
 @chat_checker(login_required=False)
 async def main_menu_handler(message: types.Message, user: User):
-    if message.chat.type == 'group':
+    if message.chat.type in GROUP_CHAT_TYPES:
         message_for_all_users = 'Используй команды /home или /start в личной переписке со мной, ' \
                                 'чтобы при совершении каких-то действий не захламлять чат сообщениями. ' \
                                 'А все важные оповещения будут показываться здесь для всех.'
+        # the group chat of a flat becomes its household with the first /start there
+        if message.chat.id not in households:
+            await households.register(message.chat.id, message.chat.title)
+        if user and user.household_id != message.chat.id:
+            return await message.answer('Ты уже состоишь в бытовухе другой квартиры')
         if not user:
             deleted_user = await User.query.where(and_(
                 User.chat_id == message.from_user.id,
                 User.deleted.isnot(None)
             )).gino.first()
-            message_for_deleted = 'снова ' if deleted_user else ''
+            message_for_deleted = 'снова ' if deleted_user and deleted_user.household_id == message.chat.id else ''
             if deleted_user:
                 async with db.transaction():
-                    await deleted_user.update(deleted=None).apply()
+                    await deleted_user.update(deleted=None, household_id=message.chat.id).apply()
+                await members.put(deleted_user)
             else:
                 async with db.transaction():
-                    await User.create(
+                    new_user = await User.create(
                         chat_id=message.from_user.id,
+                        household_id=message.chat.id,
                         firstname=message.from_user.first_name,
                         lastname=message.from_user.last_name,
                     )
+                await members.put(new_user)
             return await message.answer(f'Привет, {message.from_user.full_name}! '
-                                        f'Теперь ты {message_for_deleted}часть бытовухи квартиры на улице Радио!\n'
+                                        f'Теперь ты {message_for_deleted}часть бытовухи квартиры '
+                                        f'«{message.chat.title}»!\n'
                                         f'{message_for_all_users}')
         return await message.answer(message_for_all_users)
     if user:
@@ -100,35 +200,34 @@ async def main_menu_handler(message: types.Message, user: User):
         keyboard_markup.add(*all_buttons)
         return await message.reply('Что делаем?', reply_markup=keyboard_markup)
 
-    keyboard_markup = types.InlineKeyboardMarkup()
-    new_user_buttons = [
-        types.InlineKeyboardButton('Принимаем ✅', callback_data=new_user_data.new(
-            accept=True, id=message.from_user.id
-        )),
-        types.InlineKeyboardButton('Отклоняем ❌', callback_data=new_user_data.new(
-            accept=False, id='-'
-        )),
-    ]
-    keyboard_markup.add(*new_user_buttons)
-    admins = await User.query.where(and_(User.is_admin, User.deleted.is_(None))).gino.all()
-    for admin in admins:
-        await bot.send_message(
-            admin.chat_id,
-            f'[{message.from_user.full_name}](tg://user?id={message.from_user.id}) хочет присоединиться '
-            f'к бытовухе на Радио. Что будем делать?',
-            reply_markup=keyboard_markup,
-            parse_mode='MarkdownV2'
-        )
+    # a stranger writing in private can't be told apart from a tenant of any flat, so joining goes through the group
+    await message.answer('Добавь меня в чат своей квартиры и напиши там /start, чтобы присоединиться к бытовухе')
+
 
+@dp.message_handler(content_types=types.ContentType.LEFT_CHAT_MEMBER)
+async def left_chat_member_handler(message: types.Message):
+    # a tenant leaving the group of the flat leaves its household, a later /start there restores them
+    left = message.left_chat_member
+    if left.is_bot or message.chat.id not in households:
+        return
+    await User.update.values(deleted=datetime.now().astimezone()).where(and_(
+        User.chat_id == left.id,
+        User.household_id == message.chat.id,
+        User.deleted.is_(None)
+    )).gino.status()
+    await members.remove(left.id)
 
+
+# join requests sent to admins before households, they are accepted into the household of the admin
 @dp.callback_query_handler(new_user_data.filter())
-async def resolve_new_user(call: types.CallbackQuery, callback_data: dict):
+@member_required
+async def resolve_new_user(call: types.CallbackQuery, user: User, callback_data: dict):
     accepted = strtobool(callback_data['accept'])
     message_words_list = call.message.text.split(maxsplit=2)
 
     message_addon = '' if accepted else 'не '
-    message_for_new_user = f'Ты {message_addon}принят в бытовуху на Радио'
-    await bot.send_message(callback_data['id'], message_for_new_user)
+    message_for_new_user = f'Ты {message_addon}принят в бытовуху'
+    outbound.send_message(callback_data['id'], message_for_new_user)
 
     if accepted:
         deleted_user = await User.query.where(and_(
@@ -137,33 +236,33 @@ async def resolve_new_user(call: types.CallbackQuery, callback_data: dict):
         )).gino.first()
         if deleted_user:
             async with db.transaction():
-                await deleted_user.update(deleted=None).apply()
+                await deleted_user.update(deleted=None, household_id=user.household_id).apply()
+            await members.put(deleted_user)
         else:
             async with db.transaction():
-                await User.create(
-                    chat_id=callback_data['id'],
+                new_user = await User.create(
+                    chat_id=int(callback_data['id']),
+                    household_id=user.household_id,
                     firstname=message_words_list[0],
                     lastname=message_words_list[1],
                 )
+            await members.put(new_user)
 
-        await call.message.answer(f'Ты принял {message_words_list[0]} {message_words_list[1]} в бытовуху на Радио')
+        await call.message.answer(f'Ты принял {message_words_list[0]} {message_words_list[1]} в бытовуху')
         return await call.message.delete_reply_markup()
 
     await call.message.answer(f'Ты отклонил заявку {message_words_list[0]} {message_words_list[1]}')
     await call.message.delete_reply_markup()
 
 
-async def check_user_honesty(message: types.Message, notification_type: str):
-    today_trash_notifications = await db.select(
-        [
-            db.func.count()
-        ]
-    ).where(and_(
-        Notification.notification_type == notification_type,
-        Notification.created.cast(Date) == date.today(),
-        Notification.deleted.is_(None)
-    )).gino.scalar()
-    if today_trash_notifications >= 3:
+async def save_notification(user: User, notification_type: str):
+    # counted before the insert, so a concurrent tap already sees it
+    await activity_counters.record(user.household_id, notification_type, datetime.now().astimezone())
+    return await notifications.create(user.chat_id, user.household_id, notification_type)
+
+
+async def check_user_honesty(message: types.Message, user: User, notification_type: str):
+    if activity_counters.today(user.household_id, notification_type) >= 3:
         notification_type_triple = {
             'trash': 'Сегодня мусор уже трижды выбрасывали',
             'dishwasher_load': 'Сегодня посудомойку уже трижды загружали',
@@ -175,13 +274,14 @@ async def check_user_honesty(message: types.Message, notification_type: str):
     return True
 
 
-async def send_dishwasher_unload_notify():
-    await bot.send_message(settings.target_chat_id, 'Посудомойку можно разгружать!')
+async def send_dishwasher_unload_notify(household_id: int = None):
+    # timers set before households have no household, they belong to the flat of target_chat_id
+    outbound.send_message(household_id or settings.target_chat_id, 'Посудомойку можно разгружать!')
 
 
 @dp.message_handler(Text(equals='Посудомойка 🍴'))
 @chat_checker()
-async def dishwasher_handler(message: types.Message):
+async def dishwasher_handler(message: types.Message, user: User):
     keyboard_markup = types.InlineKeyboardMarkup()
     dishwasher_buttons = [
         types.InlineKeyboardButton('Загрузить ⬇', callback_data='dishwasher_load'),
@@ -191,9 +291,40 @@ async def dishwasher_handler(message: types.Message):
     await message.answer('Что сделать с посудомойкой?', reply_markup=keyboard_markup)
 
 
+SCHEDULED_JOBS_CHANNEL = 'scheduled_jobs'
+
+
+async def schedule_dishwasher_unload(household_id: int, run_date: datetime):
+    # the durable job store writes through a synchronous engine, so it runs off the event loop;
+    # the id deduplicates the timer, a missed one is still sent once the bot is back
+    await asyncio.get_event_loop().run_in_executor(None, partial(
+        scheduler.add_job,
+        send_dishwasher_unload_notify,
+        'date',
+        args=[household_id],
+        id=f'dishwasher_unload_{household_id}',
+        jobstore='durable',
+        replace_existing=True,
+        misfire_grace_time=None,
+        run_date=run_date,
+    ))
+    # the leader may be another process, it looks at its job stores again right away instead of at its next job
+    await broadcast.notify(SCHEDULED_JOBS_CHANNEL, household_id)
+
+
+def wake_up_scheduler(data):
+    # a paused scheduler of a process that isn't the leader ignores it
+    if scheduler.running:
+        scheduler.wakeup()
+
+
+broadcast.listen(SCHEDULED_JOBS_CHANNEL, wake_up_scheduler)
+
+
 @dp.callback_query_handler(Text(startswith='dishwasher'))
-async def dishwasher_callback(call: types.CallbackQuery):
-    honesty = await check_user_honesty(call.message, call.data)
+@member_required
+async def dishwasher_callback(call: types.CallbackQuery, user: User):
+    honesty = await check_user_honesty(call.message, user, call.data)
 
     if honesty:
         action_prefixes = {
@@ -201,45 +332,35 @@ async def dishwasher_callback(call: types.CallbackQuery):
             False: 'за'
         }
         unload = call.data.endswith('unload')
-        notification_query = Notification.query.where(and_(
-            Notification.notification_type.in_(['dishwasher_load', 'dishwasher_unload']),
-            Notification.deleted.is_(None)
-        ))
-        dishwasher_last_notification = await notification_query.order_by(Notification.created.desc()).gino.first()
-
-        if (not dishwasher_last_notification and unload) or \
-                (dishwasher_last_notification and dishwasher_last_notification.notification_type == call.data):
+        action = UNLOAD if unload else LOAD
+        dishwasher = appliances.get(user.household_id, 'dishwasher')
+
+        if (not dishwasher.action and unload) or dishwasher.action == action:
             last_time_loaded = f'\nПоследний раз {action_prefixes.get(unload)}гружалась: ' \
-                               f'{dishwasher_last_notification.created.astimezone().strftime("%d.%m.%y в %H:%M")}' \
-                if dishwasher_last_notification else ''
+                               f'{dishwasher.changed.astimezone().strftime("%d.%m.%y в %H:%M")}' \
+                if dishwasher.action else ''
             return await call.message.answer(
                 f'Прежде чем {action_prefixes.get(unload)}грузить посудомойку, '
                 f'ее надо {action_prefixes.get(not unload)}грузить{last_time_loaded}'
             )
         now = datetime.now().astimezone()
-        dishwasher_working_minutes = timedelta(minutes=DISHWASHER_TIME_LOADING)
         if unload:
-            time_to_unload = dishwasher_last_notification.created + dishwasher_working_minutes
-            if time_to_unload > now:
+            if dishwasher.is_working(now):
                 await call.message.delete_reply_markup()
                 return await call.message.answer(
-                    f'Посудомойка моет до {time_to_unload.astimezone().strftime("%H:%M")}, нельзя разгрузить'
+                    f'Посудомойка моет до {dishwasher.cycle_end.astimezone().strftime("%H:%M")}, нельзя разгрузить'
                 )
 
-        else:
-            datetime_unload = now + dishwasher_working_minutes
-            scheduler.add_job(send_dishwasher_unload_notify, 'date', run_date=datetime_unload)
-        async with db.transaction():
-            new_notification = await Notification.create(
-                user_id=call.from_user.id,
-                notification_type=call.data
-            )
-            unload_time = '' if unload \
-                else f', разгрузить можно будет в ' \
-                     f'{(new_notification.created + dishwasher_working_minutes).astimezone().strftime("%H:%M")}'
+        # the state changes before any await, so a concurrent tap already sees it
+        await appliances.change(user.household_id, 'dishwasher', action, call.from_user.id, now)
+        if not unload:
+            await schedule_dishwasher_unload(user.household_id, now + dishwasher.cycle)
+        await save_notification(user, call.data)
+        unload_time = '' if unload \
+            else f', разгрузить можно будет в {dishwasher.cycle_end.astimezone().strftime("%H:%M")}'
 
-        await bot.send_message(
-            settings.target_chat_id,
+        outbound.send_message(
+            user.household_id,
             f'{call.from_user.full_name} {action_prefixes.get(unload)}грузил(а) посудомойку{unload_time}'
         )
         await call.message.delete_reply_markup()
@@ -247,22 +368,18 @@ async def dishwasher_callback(call: types.CallbackQuery):
 
 @dp.message_handler(Text(equals='Выкинуть мусор 🗑'))
 @chat_checker()
-async def trash_handler(message: types.Message):
-    honesty = await check_user_honesty(message, 'trash')
+async def trash_handler(message: types.Message, user: User):
+    honesty = await check_user_honesty(message, user, 'trash')
     if honesty:
-        async with db.transaction():
-            await Notification.create(
-                user_id=message.from_user.id,
-                notification_type='trash'
-            )
+        await save_notification(user, 'trash')
 
         trash_message = 'выкинул(а) мусор'
-        await bot.send_message(settings.target_chat_id, f'{message.from_user.full_name} {trash_message}')
+        outbound.send_message(user.household_id, f'{message.from_user.full_name} {trash_message}')
 
 
 @dp.message_handler(Text(equals='Тусовки 🍻'))
 @chat_checker()
-async def parties_handler(message: types.Message):
+async def parties_handler(message: types.Message, user: User):
     keyboard_markup = types.InlineKeyboardMarkup(row_width=1)
     parties_buttons = [
         types.InlineKeyboardButton('Забронировать новую 🎉', callback_data='party_new'),
@@ -273,28 +390,33 @@ async def parties_handler(message: types.Message):
     await message.answer('Что по тусовкам?', reply_markup=keyboard_markup)
 
 
+def party_calendar(household_id: int):
+    today = date.today()
+    return create_calendar(booked=parties.occupancy(household_id, today.year, today.month))
+
+
 @dp.callback_query_handler(Text(equals='party_new'), state='*')
-async def plan_party_date(call: types.CallbackQuery):
-    await call.message.answer('Выбери дату', reply_markup=create_calendar())
+@member_required
+async def plan_party_date(call: types.CallbackQuery, user: User):
+    await call.message.answer('Выбери дату', reply_markup=party_calendar(user.household_id))
     await call.message.delete_reply_markup()
     await PlanParty.party_date.set()
 
 
 @dp.callback_query_handler(calendar_callback.filter(), state=PlanParty.party_date)
-async def choose_party_date(call: types.CallbackQuery, callback_data: dict, state: FSMContext):
-    selected_date = await process_calendar_selection(call, callback_data)
+@member_required
+async def choose_party_date(call: types.CallbackQuery, user: User, callback_data: dict, state: FSMContext):
+    selected_date = await process_calendar_selection(
+        call, callback_data, partial(parties.occupancy, user.household_id)
+    )
     if isinstance(selected_date, str):
         await state.finish()
         return await call.message.answer('Бронирование тусовки отменено')
     elif selected_date:
-        party = await Party.query.where(and_(
-            Party.party_date == selected_date,
-            Party.deleted.is_(None)
-        )).gino.first()
-        if party:
+        if parties.on_date(user.household_id, selected_date):
             return await call.message.reply(
                 f'Выбери другую дату. На {selected_date.strftime("%d.%m.%y")} уже забронирована тусовка',
-                reply_markup=create_calendar()
+                reply_markup=party_calendar(user.household_id)
             )
         await state.update_data(party_date=selected_date)
         await call.message.answer(f'Выбрано {selected_date.strftime("%d.%m.%y")}')
@@ -313,7 +435,7 @@ async def validate_guests_amount(message: types.Message, amount_data: str):
             'Но лучше все же ввести хотя бы одного гостя'
         )
     elif guests_amount > 50:
-        return False, await message.reply('Кажется, столько гостей квартира на Радио не потянет')
+        return False, await message.reply('Кажется, столько гостей квартира не потянет')
     return True, guests_amount
 
 
@@ -334,15 +456,35 @@ async def plan_party_using_sofa(message: types.Message, state: FSMContext):
 
 
 @dp.callback_query_handler(Text(startswith='sofa_using'), state=PlanParty.using_sofa)
-async def plan_party_save(call: types.CallbackQuery, state: FSMContext):
+@member_required
+async def plan_party_save(call: types.CallbackQuery, user: User, state: FSMContext):
     using_sofa = call.data.endswith('yes')
     await state.update_data(using_sofa=using_sofa)
     user_data = await state.get_data()
-    async with db.transaction():
-        await Party.create(user_id=call.from_user.id, **user_data)
     await state.finish()
-    await bot.send_message(
-        settings.target_chat_id,
+    party_id = await insert(Party).values(
+        user_id=call.from_user.id, household_id=user.household_id, **user_data
+    ).on_conflict_do_nothing(
+        index_elements=[Party.household_id, Party.party_date], index_where=Party.deleted.is_(None)
+    ).returning(Party.id).gino.scalar()
+    if not party_id:
+        await call.message.delete_reply_markup()
+        return await call.message.answer(
+            f"Пока ты бронировал(а), на {user_data.get('party_date').strftime('%d.%m.%y')} "
+            f"уже забронировали другую тусовку. Попробуй выбрать другую дату"
+        )
+    await parties.put(UpcomingParty(
+        party_id,
+        call.from_user.id,
+        user.household_id,
+        user_data['party_date'],
+        user_data['guests_amount'],
+        using_sofa,
+        user.firstname,
+        user.lastname,
+    ))
+    outbound.send_message(
+        user.household_id,
         f"{call.from_user.full_name} забронировал(а) тусовку {user_data.get('party_date').strftime('%d.%m.%y')}\n"
         f"Количество гостей: {user_data.get('guests_amount')}\n"
         f"Диван будет занят: {sofa_dict.get(user_data.get('using_sofa'))}"
@@ -351,12 +493,9 @@ async def plan_party_save(call: types.CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query_handler(Text(startswith='party_closest'))
-async def show_closest_parties(call: types.CallbackQuery):
-    parties_query = Party.join(User).select().where(and_(
-        Party.party_date >= date.today(),
-        Party.deleted.is_(None)
-    ))
-    closest_parties = await parties_query.order_by(Party.party_date).limit(3).gino.all()
+@member_required
+async def show_closest_parties(call: types.CallbackQuery, user: User):
+    closest_parties = parties.upcoming(user.household_id, limit=3)
 
     if closest_parties:
         parties_list = [f'Ближайшие {len(closest_parties)} тусовки:']
@@ -374,12 +513,7 @@ async def show_closest_parties(call: types.CallbackQuery):
 
 @dp.callback_query_handler(Text(equals='party_manage'))
 async def show_user_parties(call: types.CallbackQuery):
-    parties_query = Party.query.where(and_(
-        Party.user_id == call.from_user.id,
-        Party.party_date >= date.today(),
-        Party.deleted.is_(None)
-    ))
-    user_parties = await parties_query.order_by(Party.party_date).gino.all()
+    user_parties = parties.owned_by(call.from_user.id)
     if user_parties:
         keyboard_markup = types.InlineKeyboardMarkup(row_width=1)
         your_parties_buttons = [
@@ -425,43 +559,52 @@ async def user_party_manage(call: types.CallbackQuery, callback_data: dict):
 
 
 @dp.callback_query_handler(party_edit_data.filter(edit_type='party_date'), state='*')
-async def edit_party_date(call: types.CallbackQuery, callback_data: dict, state: FSMContext):
+@member_required
+async def edit_party_date(call: types.CallbackQuery, user: User, callback_data: dict, state: FSMContext):
     await state.update_data(party_id=int(callback_data['id']))
-    await call.message.answer('Выбери новую дату', reply_markup=create_calendar())
+    await call.message.answer('Выбери новую дату', reply_markup=party_calendar(user.household_id))
     await call.message.delete_reply_markup()
     await EditPartyDate.edit_party_date.set()
 
 
 @dp.callback_query_handler(calendar_callback.filter(), state=EditPartyDate.edit_party_date)
-async def choose_new_party_date(call: types.CallbackQuery, callback_data: dict, state: FSMContext):
-    selected_date = await process_calendar_selection(call, callback_data)
+@member_required
+async def choose_new_party_date(call: types.CallbackQuery, user: User, callback_data: dict, state: FSMContext):
+    selected_date = await process_calendar_selection(
+        call, callback_data, partial(parties.occupancy, user.household_id)
+    )
     if selected_date:
         user_data = await state.get_data()
         await state.finish()
 
         if isinstance(selected_date, str):
             return await call.message.answer('Изменение даты отменено')
-        party_with_the_same_date = await Party.query.where(and_(
-            Party.id != user_data.get('party_id'),
-            Party.party_date == selected_date,
-            Party.deleted.is_(None)
-        )).gino.first()
-        if party_with_the_same_date:
-            return await call.message.reply(
-                f'Выбери другую дату. На {selected_date.strftime("%d.%m.%y")} уже забронирована тусовка',
-                reply_markup=create_calendar()
-            )
-        party = await Party.query.where(Party.id == user_data.get('party_id')).gino.first()
+        party = parties.get(user.household_id, user_data.get('party_id'))
+        if not party:
+            return await call.message.answer(PARTY_GONE_MESSAGE)
         old_date = party.party_date
         if selected_date == old_date:
             await call.message.answer('Дата не изменилась')
         else:
-            async with db.transaction():
-                await party.update(party_date=selected_date).apply()
-            await bot.send_message(
-                settings.target_chat_id,
+            booked = bool(parties.on_date(user.household_id, selected_date))
+            if not booked:
+                try:
+                    await Party.update.values(party_date=selected_date).where(Party.id == party.id).gino.status()
+                except UniqueViolationError:
+                    # booked by another worker whose change has not reached this one yet
+                    booked = True
+            if booked:
+                await state.update_data(party_id=party.id)
+                await EditPartyDate.edit_party_date.set()
+                return await call.message.reply(
+                    f'Выбери другую дату. На {selected_date.strftime("%d.%m.%y")} уже забронирована тусовка',
+                    reply_markup=party_calendar(user.household_id)
+                )
+            await parties.put(party._replace(party_date=selected_date))
+            outbound.send_message(
+                user.household_id,
                 f'{call.from_user.full_name} изменил дату тусовки '
-                f'с {old_date.strftime("%d.%m.%y")} на {party.party_date.strftime("%d.%m.%y")}'
+                f'с {old_date.strftime("%d.%m.%y")} на {selected_date.strftime("%d.%m.%y")}'
             )
 
 
@@ -473,118 +616,119 @@ async def edit_party_guests_amount(call: types.CallbackQuery, callback_data: dic
 
 
 @dp.message_handler(state=EditPartyGuestsAmount.edit_party_guests_amount)
-async def choose_party_guests_amount(message: types.Message, state: FSMContext):
+@member_required
+async def choose_party_guests_amount(message: types.Message, user: User, state: FSMContext):
     validated, guests_amount = await validate_guests_amount(message, message.text)
 
     if validated:
         user_data = await state.get_data()
-        party = await Party.query.where(Party.id == user_data.get('party_id')).gino.first()
+        party = parties.get(user.household_id, user_data.get('party_id'))
         await state.finish()
+        if not party:
+            return await message.answer(PARTY_GONE_MESSAGE)
         old_guests_amount = party.guests_amount
         if guests_amount == old_guests_amount:
             await message.answer('Количество гостей не изменилось')
         else:
-            async with db.transaction():
-                await party.update(guests_amount=guests_amount).apply()
-            await bot.send_message(
-                settings.target_chat_id,
+            await Party.update.values(guests_amount=guests_amount).where(Party.id == party.id).gino.status()
+            await parties.put(party._replace(guests_amount=guests_amount))
+            outbound.send_message(
+                user.household_id,
                 f'{message.from_user.full_name} изменил количество гостей тусовки '
                 f'{party.party_date.strftime("%d.%m.%y")} с {old_guests_amount} на {guests_amount}'
             )
 
 
 @dp.callback_query_handler(party_edit_data.filter(edit_type='sofa_using'))
-async def reverse_party_sofa_using(call: types.CallbackQuery, callback_data: dict):
-    party = await Party.query.where(Party.id == int(callback_data['id'])).gino.first()
+@member_required
+async def reverse_party_sofa_using(call: types.CallbackQuery, user: User, callback_data: dict):
+    party = parties.get(user.household_id, int(callback_data['id']))
+    if not party:
+        return await call.message.answer(PARTY_GONE_MESSAGE)
     old_using_sofa = party.using_sofa
-    async with db.transaction():
-        await party.update(using_sofa=not old_using_sofa).apply()
+    await Party.update.values(using_sofa=not old_using_sofa).where(Party.id == party.id).gino.status()
+    await parties.put(party._replace(using_sofa=not old_using_sofa))
 
-    await bot.send_message(
-        settings.target_chat_id,
+    outbound.send_message(
+        user.household_id,
         f'{call.from_user.full_name} изменил использование дивана тусовки {party.party_date.strftime("%d.%m.%y")} '
-        f'с «{sofa_dict.get(old_using_sofa)}» на «{sofa_dict.get(party.using_sofa)}»'
+        f'с «{sofa_dict.get(old_using_sofa)}» на «{sofa_dict.get(not old_using_sofa)}»'
     )
 
 
 @dp.callback_query_handler(party_edit_data.filter(edit_type='delete_party'))
-async def delete_party(call: types.CallbackQuery, callback_data: dict):
-    party = await Party.query.where(and_(
-        Party.id == int(callback_data['id']),
-        Party.deleted.is_(None)
-    )).gino.first()
-    async with db.transaction():
-        await party.update(deleted=datetime.now().astimezone()).apply()
-    await bot.send_message(
-        settings.target_chat_id,
+@member_required
+async def delete_party(call: types.CallbackQuery, user: User, callback_data: dict):
+    party = parties.get(user.household_id, int(callback_data['id']))
+    if not party:
+        return await call.message.answer(PARTY_GONE_MESSAGE)
+    await Party.update.values(deleted=datetime.now().astimezone()).where(Party.id == party.id).gino.status()
+    await parties.remove(party.id)
+    outbound.send_message(
+        user.household_id,
         f'{call.from_user.full_name} не будет устраивать тусовку {party.party_date.strftime("%d.%m.%y")}'
     )
     await call.message.delete_reply_markup()
 
 
-async def prepare_rating(header: str, cron: bool = False):
+@coalesce
+async def prepare_rating(household_id: int, header: str, cron: bool = False):
     users_with_notifications = await db.select(
         [
             User.chat_id,
             User.firstname,
             User.lastname,
-            db.func.count(Notification.id).label('total'),
-            db.func.count(case(
-                [((Notification.notification_type.startswith('dishwasher')), Notification.id)])).label('dishwasher'),
-            db.func.count(case(
-                [((Notification.notification_type == 'trash'), Notification.id)])).label('trash')
+            db.func.sum(ActivityRollup.amount).label('total'),
+            db.func.sum(case(
+                [((ActivityRollup.notification_type.startswith('dishwasher')), ActivityRollup.amount)], else_=0
+            )).label('dishwasher'),
+            db.func.sum(case(
+                [((ActivityRollup.notification_type == 'trash'), ActivityRollup.amount)], else_=0
+            )).label('trash')
         ]
     ).select_from(
-        User.join(Notification)
+        User.join(ActivityRollup)
     ).where(and_(
-        Notification.notification_type != 'silence',
-        Notification.deleted.is_(None)
+        ActivityRollup.household_id == household_id,
+        ActivityRollup.notification_type != 'silence'
     )).group_by(
         User.chat_id
+    ).having(
+        db.func.sum(ActivityRollup.amount) > 0
     ).order_by(text('total DESC')).gino.all()
     users_list = [f'{i}. {u.firstname} {u.lastname}   -   {u.dishwasher}🍴,   {u.trash}🗑'
                   for i, u in enumerate(users_with_notifications, 1)]
     if users_list:
         users_list.insert(0, f'{header}:')
     if cron:
-        users_without_notifications = await User.query.where(User.chat_id.notin_([
-            u.chat_id for u in users_with_notifications
-        ])).gino.all()
-        return '\n'.join(users_list), users_with_notifications[-1], users_without_notifications
+        users_without_notifications = await User.query.where(and_(
+            User.household_id == household_id,
+            User.chat_id.notin_([u.chat_id for u in users_with_notifications])
+        )).gino.all()
+        worst_user = users_with_notifications[-1] if users_with_notifications else None
+        return '\n'.join(users_list), worst_user, users_without_notifications
 
     return '\n'.join(users_list)
 
 
 @dp.message_handler(Text(equals='Тише 🤫'))
 @chat_checker()
-async def parties_handler(message: types.Message):
-    last_silence_notifications = await db.select(
-        [
-            db.func.count()
-        ]
-    ).where(and_(
-        Notification.notification_type == 'silence',
-        Notification.created > datetime.now().astimezone() - timedelta(minutes=30),
-        Notification.deleted.is_(None)
-    )).gino.scalar()
+async def silence_handler(message: types.Message, user: User):
+    last_silence_notifications = activity_counters.recent(user.household_id, 'silence')
     if last_silence_notifications:
         if last_silence_notifications == 3:
             return await message.answer('Просьбы не подействовали. Видимо стоит сходить поговорить без моей помощи')
         else:
-            await bot.send_message(settings.target_chat_id, 'Попросили же сделать потише! Или нужно выйти разобраться?')
+            outbound.send_message(user.household_id, 'Попросили же сделать потише! Или нужно выйти разобраться?')
     else:
-        await bot.send_message(settings.target_chat_id, 'Слишком громко! Можно потише?')
+        outbound.send_message(user.household_id, 'Слишком громко! Можно потише?')
 
-    async with db.transaction():
-        await Notification.create(
-            user_id=message.from_user.id,
-            notification_type='silence'
-        )
+    await save_notification(user, 'silence')
 
 
 @dp.message_handler(Text(equals='Статистика 📊'))
 @chat_checker()
-async def statistics_handler(message: types.Message):
+async def statistics_handler(message: types.Message, user: User):
     keyboard_markup = types.InlineKeyboardMarkup()
     parties_buttons = [
         types.InlineKeyboardButton('Рейтинг', callback_data='statistics_usefulness'),
@@ -595,8 +739,9 @@ async def statistics_handler(message: types.Message):
 
 
 @dp.callback_query_handler(Text(equals='statistics_usefulness'))
-async def show_rating(call: types.CallbackQuery):
-    rating = await prepare_rating(header='Рейтинг активности жильцов')
+@member_required
+async def show_rating(call: types.CallbackQuery, user: User):
+    rating = await prepare_rating(user.household_id, header='Рейтинг активности жильцов')
     if rating:
         await call.message.answer(rating)
     else:
@@ -604,40 +749,99 @@ async def show_rating(call: types.CallbackQuery):
     await call.message.delete_reply_markup()
 
 
-@dp.callback_query_handler(Text(equals='statistics_silence'))
-async def show_silence_statistics(call: types.CallbackQuery):
-    silence_notifications = await db.select(
+@coalesce
+async def silence_statistics(user_id: int, household_id: int):
+    return await db.select(
         [
-            db.func.count(case(
-                [((Notification.user_id == call.from_user.id), Notification.id)])).label('yours'),
-            db.func.count(case(
-                [((Notification.user_id != call.from_user.id), Notification.id)])).label('others')
+            db.func.coalesce(db.func.sum(case(
+                [((ActivityRollup.user_id == user_id), ActivityRollup.amount)], else_=0
+            )), 0).label('yours'),
+            db.func.coalesce(db.func.sum(case(
+                [((ActivityRollup.user_id != user_id), ActivityRollup.amount)], else_=0
+            )), 0).label('others')
         ]
+    ).select_from(
+        User.join(ActivityRollup)
     ).where(and_(
-        Notification.notification_type == 'silence',
-        Notification.deleted.is_(None)
+        ActivityRollup.household_id == household_id,
+        ActivityRollup.notification_type == 'silence'
     )).gino.first()
+
+
+@dp.callback_query_handler(Text(equals='statistics_silence'))
+@member_required
+async def show_silence_statistics(call: types.CallbackQuery, user: User):
+    silence_notifications = await silence_statistics(call.from_user.id, user.household_id)
     await call.message.answer(f'За все время ты пожаловался на шум {silence_notifications.yours} раз, '
                               f'а другие пожаловались {silence_notifications.others} раз')
     await call.message.delete_reply_markup()
 
 
+# Telegram drops longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dp.message_handler(commands=['slow_queries'])
+@chat_checker()
+async def slow_queries_handler(message: types.Message, user: User):
+    if not user.is_admin:
+        return
+    slowest = query_stats.slowest()
+    args = message.get_args()
+    if args.isdigit() and 0 < int(args) <= len(slowest):
+        shape = slowest[int(args) - 1]
+        text_message = f'{shape.shape}\n\n{shape.plan or "План еще не снят"}'
+    elif slowest:
+        # stats of the worker process that got the command
+        text_message = '\n\n'.join(
+            f'{i}. {s.mean * 1000:.1f} мс в среднем, {s.max * 1000:.1f} мс максимум, '
+            f'вызовов: {s.count}, медленных: {s.slow}{", есть план" if s.plan else ""}\n{s.shape[:300]}'
+            for i, s in enumerate(slowest, 1)
+        ) + '\n\nПлан запроса: /slow_queries <номер>'
+    else:
+        text_message = 'Запросов еще не было'
+    await message.answer(text_message[:MAX_MESSAGE_LENGTH])
+
+
+@dp.message_handler(commands=['export'])
+@chat_checker()
+async def export_handler(message: types.Message, user: User):
+    if not user.is_admin:
+        return
+    fmt = message.get_args().strip().lower() or FORMATS[0]
+    if fmt not in FORMATS:
+        await message.answer(f'Формат выгрузки: {" или ".join(FORMATS)}')
+    elif history_export.start(user.household_id, fmt, message.chat.id):
+        await message.answer('Выгружаю историю, файлы придут по частям')
+    else:
+        await message.answer('Выгрузка уже идет, попробуй позже')
+
+
 async def show_cron_rating():
+    # households one by one, so the daily jobs don't take the whole pool from the handlers
+    for household_id in households:
+        try:
+            await show_household_rating(household_id)
+        except Exception:
+            logger.exception(f'Failed to send the daily rating to household {household_id}')
+
+
+async def show_household_rating(household_id: int):
     rating, worst_user_with_notifications, users_without_notifications = await prepare_rating(
-        header='Сводка самых активных жильцов', cron=True
+        household_id, header='Сводка самых активных жильцов', cron=True
     )
     if rating:
-        await bot.send_message(settings.target_chat_id, rating)
+        outbound.send_message(household_id, rating)
         if users_without_notifications:
             tag_users = [f'[{u.firstname}](tg://user?id={u.chat_id})' for u in users_without_notifications]
             plurality_message = 'вас' if len(users_without_notifications) > 1 else 'тебя'
-            return await bot.send_message(
-                settings.target_chat_id,
+            return outbound.send_message(
+                household_id,
                 f'{" ,".join(tag_users)}, у {plurality_message} по нулям, пора сделать что\-то полезное в квартире',
                 parse_mode='MarkdownV2'
             )
-        return await bot.send_message(
-            settings.target_chat_id,
+        return outbound.send_message(
+            household_id,
             f'[{worst_user_with_notifications.firstname}](tg://user?id={worst_user_with_notifications.chat_id}), '
             f'пришла твоя очередь сделать что\-то полезное в квартире',
             parse_mode='MarkdownV2'
@@ -645,12 +849,12 @@ async def show_cron_rating():
 
 
 async def show_cron_closest_parties():
-    parties_query = Party.join(User).select().where(and_(
-        Party.party_date >= date.today(),
-        Party.party_date <= date.today() + timedelta(days=3),
-        Party.deleted.is_(None)
-    ))
-    closest_parties = await parties_query.order_by(Party.party_date).gino.all()
+    for household_id in parties.households():
+        show_household_closest_parties(household_id)
+
+
+def show_household_closest_parties(household_id: int):
+    closest_parties = parties.upcoming(household_id, until=date.today() + timedelta(days=3))
     if closest_parties:
         closest_parties_dict = {
             0: 'Сегодня',
@@ -664,66 +868,159 @@ async def show_cron_closest_parties():
                              f'кем забронирована: {p.firstname} {p.lastname}'
                              for i, p in enumerate(closest_parties, 1)])
 
-        await bot.send_message(settings.target_chat_id, '\n'.join(parties_list))
+        outbound.send_message(household_id, '\n'.join(parties_list))
 
 
-async def check_dishwasher_loading():
-    notification_query = Notification.query.where(and_(
-        Notification.notification_type.in_(['dishwasher_load', 'dishwasher_unload']),
-        Notification.deleted.is_(None)
-    ))
-    dishwasher_last_notification = await notification_query.order_by(Notification.created.desc()).gino.first()
-    dishwasher_working_minutes = timedelta(minutes=DISHWASHER_TIME_LOADING)
-    if dishwasher_last_notification and dishwasher_last_notification.notification_type == 'dishwasher_load' and \
-            dishwasher_last_notification.created + dishwasher_working_minutes > datetime.now().astimezone():
-        scheduler.add_job(
-            send_dishwasher_unload_notify,
-            'date',
-            run_date=dishwasher_last_notification.created + dishwasher_working_minutes
-        )
+async def archive_old_notifications():
+    await archive_notifications(**settings.notifications_retention)
 
 
 def schedule_daily_notifications():
-    now_with_gap = datetime.now().astimezone() + timedelta(seconds=5)
-
-    scheduler.add_job(show_cron_rating, 'cron', hour=0, minute=0)
-    scheduler.add_job(show_cron_closest_parties, 'cron', hour=0, minute=0)
-    scheduler.add_job(
-        check_dishwasher_loading,
-        'cron',
-        hour=now_with_gap.hour,
-        minute=now_with_gap.minute,
-        second=now_with_gap.second
-    )
+    durable_job = {'jobstore': 'durable', 'replace_existing': True, 'misfire_grace_time': 3600}
+    scheduler.add_job(show_cron_rating, 'cron', id='show_cron_rating', hour=0, minute=0, **durable_job)
+    scheduler.add_job(show_cron_closest_parties, 'cron', id='show_cron_closest_parties', hour=0, minute=0,
+                      **durable_job)
+    # the rating is read from the rollup, so the archived notifications keep counting in it
+    scheduler.add_job(archive_old_notifications, 'cron', id='archive_old_notifications', hour=3, minute=0,
+                      **durable_job)
+    scheduler.add_job(dp.storage.purge_expired, 'interval', id='purge_fsm_states', hours=1, replace_existing=True)
+    scheduler.resume()
+
+
+async def load_state():
+    # in-memory state of every household, restored from the database
+    await households.load()
+    await members.load()
+    await appliances.load(households)
+    await parties.load()
+    await activity_counters.load()
+
+
+async def init_app(dp):
+    url = get_database_url()
+    logging.info(f'Connecting to DB: {url}')
+    # repeated query shapes are compiled to the same SQL, so asyncpg's statement cache prepares each once per connection
+    await db.set_bind(url, pool_class=InstrumentedPool, **settings.database_pool)
+    instrument_engine(db.bind)
+    await warm_up_pool(settings.database_pool.min_size)
+    await migrate()
+    await broadcast.start()
+    await load_state()
+    await outbound.start()
+    instrument_dispatcher(dp, tracer)
+    dp['fsm_states_refresher'] = asyncio.ensure_future(refresh_fsm_states(settings.metrics.fsm_states_interval))
+    # every process can add jobs to the durable store, but only the leader runs them
+    scheduler.start(paused=True)
+    await scheduler_leader.start(on_elected=schedule_daily_notifications, on_lost=scheduler.pause)
+
+
+async def close_app(dp):
+    logging.info(f'Members cache stats: {members.stats}')
+
+    # an unfinished export is dropped, its next file would wait for the outbound workers forever
+    await history_export.close()
+    await outbound.close(timeout=settings.catch_up.drain_timeout)
+    logging.info(f'Outbound stats: {outbound.stats}')
+    # buffered notifications have to be written before the pool is closed
+    await notifications.close()
+
+    dp['fsm_states_refresher'].cancel()
+    scheduler.shutdown(wait=False)
+    await scheduler_leader.close()
+    await broadcast.close()
+    logging.info(f'DB pool stats: {pool_stats.stats}')
+    await db.pop_bind().close()
 
+    # Close DB connection (if used)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
 
-async def on_startup(dp):
-    logging.info('Starting app...')
-    url = f'postgresql://{settings.database.user}:{settings.database.password}' \
-          f'@{settings.database.host}:5432/{settings.database.name}'
-    logging.info(f'Connecting to DB: {url}')
-    await db.set_bind(url)
-    await db.gino.create_all()
-    schedule_daily_notifications()
-    scheduler.start()
-    await bot.set_webhook(f'{settings.webhook.host}{settings.webhook.path}')
+
+async def set_webhook(drop_pending_updates: bool = False):
+    await bot.set_webhook(
+        f'{settings.webhook.host}{settings.webhook.path}',
+        drop_pending_updates=drop_pending_updates or None
+    )
     webhook = await bot.get_webhook_info()
     if webhook.url and webhook.url == f'{settings.webhook.host}{settings.webhook.path}':
         logging.info(f"Webhook configured. Pending updates count {webhook.pending_update_count}")
     else:
-        logging.error("Configured wrong webhook URL {webhook}", webhook=webhook.url)
+        logging.error(f"Configured wrong webhook URL {webhook.url}")
+
+
+async def catch_up(handle_batch):
+    """
+    Handles the updates that came while the bot was down before the webhook is set again.
+    :param handle_batch: Coroutine function getting a list of raw updates.
+    """
+    started = time.monotonic()
+    await bot.delete_webhook()
+    amount = await fetch_pending_updates(bot, handle_batch)
+    logging.info(f'Caught up with {amount} pending updates in {time.monotonic() - started:.1f} s')
+
+
+async def process_raw_batch(batch):
+    # ordered per user like live traffic, but with a bounded amount of updates at once
+    processor = OrderedProcessor(process_raw_update, settings.catch_up.concurrency)
+    for data in batch:
+        processor.submit(update_routing_key(data), data)
+    await processor.join()
+
+
+async def on_startup(dp):
+    logging.info('Starting app...')
+    await init_app(dp)
+    if settings.catch_up.enabled:
+        await catch_up(process_raw_batch)
+    await set_webhook(drop_pending_updates=not settings.catch_up.enabled)
 
 
 async def on_shutdown(dp):
     logging.warning('Shutting down..')
+    # Remove webhook first, updates coming meanwhile wait in Telegram for the next catch up
+    await bot.delete_webhook()
+    left = await in_flight.wait_idle(settings.catch_up.drain_timeout)
+    if left:
+        logging.warning(f'Shutting down with {left} updates still processed')
+    await close_app(dp)
+
+    logging.warning('Bye!')
 
-    await db.pop_bind().close()
 
-    # Remove webhook (not acceptable in some cases)
+async def front_startup(pool):
+    if settings.catch_up.enabled:
+        async def dispatch_batch(batch):
+            for data in batch:
+                pool.dispatch(data)
+
+        await catch_up(dispatch_batch)
+    await set_webhook(drop_pending_updates=not settings.catch_up.enabled)
+
+
+async def front_shutdown(pool):
     await bot.delete_webhook()
 
-    # Close DB connection (if used)
-    await dp.storage.close()
-    await dp.storage.wait_closed()
 
-    logging.warning('Bye!')
+async def worker_startup(index: int):
+    await init_app(dp)
+    # workers have no web app, each serves metrics on its own port
+    dp['metrics_runner'] = await serve_metrics(
+        settings.host, settings.metrics.worker_port + index, settings.metrics.path
+    )
+
+
+async def process_raw_update(data: dict):
+    Dispatcher.set_current(dp)
+    Bot.set_current(bot)
+    # through updates_handler, like the webhook executor, so update middlewares run
+    await dp.updates_handler.notify(types.Update(**data))
+
+
+async def worker_shutdown():
+    await dp['metrics_runner'].cleanup()
+    await close_app(dp)
+    await bot.close()
+
+
+def worker_hooks(index: int):
+    return partial(worker_startup, index), process_raw_update, worker_shutdown
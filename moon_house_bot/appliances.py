@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, column, table, text
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import Notification, db
+
+LOAD = 'load'
+UNLOAD = 'unload'
+
+
+class ApplianceState:
+    """
+    Last action done with an appliance, stored in notifications as '<appliance>_load' and '<appliance>_unload'.
+    :param timedelta cycle: How long the appliance works after it is loaded.
+    """
+
+    def __init__(self, name: str, cycle: timedelta):
+        self.name = name
+        self.cycle = cycle
+        self.action = None
+        self.actor = None
+        self.changed = None
+
+    @property
+    def cycle_end(self):
+        return self.changed + self.cycle if self.action == LOAD else None
+
+    def is_working(self, now: datetime):
+        return self.action == LOAD and self.cycle_end > now
+
+    def apply(self, action: str, actor: int, changed: datetime):
+        # changes come from this process and from the others, only the newest one counts
+        if self.changed and changed <= self.changed:
+            return False
+        self.action, self.actor, self.changed = action, actor, changed
+        return True
+
+
+class ApplianceCycles:
+    """
+    In-memory state of the household appliances of every household, restored from the notifications on startup,
+    the archived ones included.
+    A household without any notifications gets its appliances on the first access.
+    With several bot processes every change is broadcast and applied by the others.
+    :param dict cycles: Minutes every appliance works after it is loaded, keyed by appliance name.
+    :param Broadcast broadcast: Channel to the other bot processes.
+    """
+    channel = 'appliance_cycles'
+
+    def __init__(self, cycles: dict, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.cycles = {name: timedelta(minutes=m) for name, m in cycles.items()}
+        self._households = {}
+        broadcast.listen(self.channel, self._on_change)
+
+    def get(self, household_id: int, name: str) -> ApplianceState:
+        appliances = self._households.get(household_id)
+        if appliances is None:
+            appliances = self._households[household_id] = {
+                n: ApplianceState(n, cycle) for n, cycle in self.cycles.items()
+            }
+        return appliances[name]
+
+    async def load(self, household_ids=()):
+        """
+        :param household_ids: Households to look for in older partitions and in the archive
+            if they had no notifications this month.
+        """
+        # the last load and the last unload of every appliance of every household, the newer one wins;
+        # active households are found in the partition of the current month, older ones are read for the rest only
+        types = [f'{name}_{action}' for name in self.cycles for action in (LOAD, UNLOAD)]
+        # partitions are split by months in UTC
+        month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        live = Notification.__table__
+        self._households.clear()
+        seen = set()
+        self._apply_rows(await self._last_actions(live, types, live.c.created >= month_start), seen)
+        missing = self._missing(household_ids, types, seen)
+        if missing:
+            self._apply_rows(await self._last_actions(live, types, and_(
+                live.c.created < month_start,
+                live.c.household_id.in_(missing),
+            )), seen)
+            missing = self._missing(household_ids, types, seen)
+        # the archive has no model, it is partitioned and created by the migrations only
+        if missing and await db.scalar(text("SELECT to_regclass('notifications_archive') IS NOT NULL")):
+            archive = table('notifications_archive', column('household_id'), column('notification_type'),
+                            column('user_id'), column('created'), column('deleted'))
+            self._apply_rows(await self._last_actions(archive, types, archive.c.household_id.in_(missing)), seen)
+
+    @staticmethod
+    def _missing(household_ids, types: list, seen: set):
+        return {h for h in household_ids if any((h, t) not in seen for t in types)}
+
+    def _apply_rows(self, rows, seen: set):
+        for household_id, notification_type, user_id, created in rows:
+            seen.add((household_id, notification_type))
+            name, _, action = notification_type.rpartition('_')
+            self.get(household_id, name).apply(action, user_id, created)
+
+    @staticmethod
+    async def _last_actions(source, types: list, window):
+        return await db.select([
+            source.c.household_id,
+            source.c.notification_type,
+            source.c.user_id,
+            source.c.created,
+        ]).where(and_(
+            source.c.notification_type.in_(types),
+            source.c.deleted.is_(None),
+            window,
+        )).distinct(
+            source.c.household_id, source.c.notification_type
+        ).order_by(
+            source.c.household_id, source.c.notification_type, source.c.created.desc()
+        ).gino.all()
+
+    async def change(self, household_id: int, name: str, action: str, actor: int, changed: datetime):
+        self.get(household_id, name).apply(action, actor, changed)
+        await self.broadcast.notify(self.channel, {
+            'household_id': household_id, 'name': name, 'action': action, 'actor': actor,
+            'changed': changed.isoformat(),
+        })
+
+    def _on_change(self, change: dict):
+        if change['name'] in self.cycles:
+            self.get(change['household_id'], change['name']).apply(
+                change['action'], change['actor'], datetime.fromisoformat(change['changed'])
+            )
@@ -0,0 +1,57 @@
+import json
+import logging
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from moon_house_bot.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcast:
+    """
+    Shares changes of in-memory state between the bot processes with Postgres LISTEN/NOTIFY.
+    Changes sent by this process are not delivered back to it.
+    :param bool enabled: Whether there are other processes to share with, if not nothing is sent or listened to.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.origin = uuid4().hex
+        self._listeners = {}
+        self._connection = None
+
+    def listen(self, channel: str, callback):
+        """
+        :param callback: Function getting the data sent by another process.
+        """
+        self._listeners[channel] = callback
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._connection = await db.acquire(reuse=False)
+        for channel in self._listeners:
+            await self._connection.raw_connection.add_listener(channel, self._dispatch)
+
+    async def notify(self, channel: str, data):
+        if self.enabled:
+            payload = json.dumps({'origin': self.origin, 'data': data})
+            await db.status(text('SELECT pg_notify(:channel, :payload)'), channel=channel, payload=payload)
+
+    def _dispatch(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+        if message['origin'] == self.origin:
+            return
+        try:
+            self._listeners[channel](message['data'])
+        except Exception:
+            logger.exception(f'Failed to apply a change from {channel}')
+
+    async def close(self):
+        if self._connection:
+            for channel in self._listeners:
+                await self._connection.raw_connection.remove_listener(channel, self._dispatch)
+            await self._connection.release()
+            self._connection = None
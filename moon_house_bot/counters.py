@@ -0,0 +1,91 @@
+from collections import Counter, defaultdict, deque
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import and_
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import Notification, db
+
+
+class ActivityCounters:
+    """
+    Amounts of notifications of every type created today and within sliding windows in every household,
+    kept in memory and keyed by (household id, notification type).
+    Seeded from the database on startup, daily amounts start over at local midnight.
+    With several bot processes every recorded notification is broadcast to the others.
+    :param dict windows: Seconds of the sliding window, keyed by notification type.
+    :param Broadcast broadcast: Channel to the other bot processes.
+    """
+    channel = 'activity_counters'
+
+    def __init__(self, windows: dict, broadcast: Broadcast):
+        self.windows = {t: timedelta(seconds=s) for t, s in windows.items()}
+        self.broadcast = broadcast
+        self._day = date.today()
+        self._daily = Counter()
+        self._recent = defaultdict(deque)
+        broadcast.listen(self.channel, self._on_record)
+
+    async def load(self):
+        self._day = date.today()
+        day_start = datetime.combine(self._day, time()).astimezone()
+        rows = await db.select([
+            Notification.household_id, Notification.notification_type, db.func.count()
+        ]).where(and_(
+            Notification.created >= day_start,
+            Notification.deleted.is_(None)
+        )).group_by(Notification.household_id, Notification.notification_type).gino.all()
+        self._daily = Counter({(household_id, t): amount for household_id, t, amount in rows})
+
+        self._recent.clear()
+        now = datetime.now().astimezone()
+        for notification_type, window in self.windows.items():
+            recent = await db.select([Notification.household_id, Notification.created]).where(and_(
+                Notification.notification_type == notification_type,
+                Notification.created > now - window,
+                Notification.deleted.is_(None)
+            )).order_by(Notification.created).gino.all()
+            for household_id, created in recent:
+                self._recent[(household_id, notification_type)].append(created)
+
+    def _apply(self, household_id: int, notification_type: str, created: datetime):
+        if created.astimezone().date() == self._roll():
+            self._daily[(household_id, notification_type)] += 1
+        if notification_type in self.windows:
+            self._recent[(household_id, notification_type)].append(created)
+
+    async def record(self, household_id: int, notification_type: str, created: datetime):
+        self._apply(household_id, notification_type, created)
+        await self.broadcast.notify(self.channel, {
+            'household_id': household_id, 'type': notification_type, 'created': created.isoformat()
+        })
+
+    def _on_record(self, record: dict):
+        self._apply(record['household_id'], record['type'], datetime.fromisoformat(record['created']))
+
+    def _roll(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._daily.clear()
+        return today
+
+    def today(self, household_id: int, notification_type: str):
+        self._roll()
+        return self._daily[(household_id, notification_type)]
+
+    def recent(self, household_id: int, notification_type: str):
+        """
+        :return: Returns int amount of notifications of the type in the household within its sliding window.
+        """
+        key = (household_id, notification_type)
+        recent = self._recent.get(key)
+        if recent is None:
+            return 0
+        since = datetime.now().astimezone() - self.windows[notification_type]
+        while recent and recent[0] <= since:
+            recent.popleft()
+        if not recent:
+            # quiet households don't keep empty deques around
+            del self._recent[key]
+        return len(recent)
@@ -1,9 +1,29 @@
-from .db import db
-from .models import User, Notification, Party
+from .activity import NotificationBuffer, backfill_activity, create_notification
+from .db import db, get_database_url
+from .migrations import migrate
+from .models import ActivityRollup, FsmState, Household, Notification, Party, User
+from .partitions import archive_notifications, create_live_partitions
+from .pool import InstrumentedPool, pool_stats, warm_up_pool
+from .queries import instrument_engine, query_stats
 
 __all__ = [
     'db',
+    'get_database_url',
+    'migrate',
+    'Household',
     'User',
     'Notification',
-    'Party'
+    'Party',
+    'ActivityRollup',
+    'FsmState',
+    'archive_notifications',
+    'create_live_partitions',
+    'backfill_activity',
+    'create_notification',
+    'NotificationBuffer',
+    'InstrumentedPool',
+    'pool_stats',
+    'warm_up_pool',
+    'instrument_engine',
+    'query_stats',
 ]
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import Date, and_, cast, column, func, select, table, text, union_all
+from sqlalchemy.dialects.postgresql import insert
+
+from moon_house_bot.database.db import db
+from moon_house_bot.database.models import ActivityRollup, Notification
+from moon_house_bot.metrics import dropped_notifications
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_KEY = [ActivityRollup.household_id, ActivityRollup.user_id, ActivityRollup.notification_type, ActivityRollup.day]
+
+
+async def _bump_activity(notification: Notification, delta: int):
+    # the day is cast on the DB side, the same way the backfill and honesty check do it
+    statement = insert(ActivityRollup).values(
+        household_id=notification.household_id,
+        user_id=notification.user_id,
+        notification_type=notification.notification_type,
+        day=cast(notification.created, Date),
+        amount=delta,
+    )
+    await statement.on_conflict_do_update(
+        index_elements=ROLLUP_KEY,
+        set_={'amount': ActivityRollup.amount + statement.excluded.amount},
+    ).gino.status()
+
+
+async def create_notification(user_id: int, household_id: int, notification_type: str):
+    async with db.transaction():
+        notification = await Notification.create(
+            user_id=user_id, household_id=household_id, notification_type=notification_type
+        )
+        await _bump_activity(notification, 1)
+    return notification
+
+
+async def _write_notifications(batch):
+    async with db.transaction():
+        rows = await insert(Notification).values([
+            {
+                'user_id': n.user_id,
+                'household_id': n.household_id,
+                'notification_type': n.notification_type,
+                'created': n.created,
+            } for n in batch
+        ]).returning(Notification.id).gino.all()
+        day = cast(Notification.created, Date)
+        amounts = select([
+            Notification.household_id,
+            Notification.user_id,
+            Notification.notification_type,
+            day,
+            func.count(),
+        ]).where(and_(
+            Notification.id.in_([row[0] for row in rows]),
+            # lets the planner skip the partitions of the earlier months
+            Notification.created >= min(n.created for n in batch),
+        )).group_by(Notification.household_id, Notification.user_id, Notification.notification_type, day)
+        statement = insert(ActivityRollup).from_select(
+            ['household_id', 'user_id', 'notification_type', 'day', 'amount'], amounts
+        )
+        await statement.on_conflict_do_update(
+            index_elements=ROLLUP_KEY,
+            set_={'amount': ActivityRollup.amount + statement.excluded.amount},
+        ).gino.status()
+
+
+class NotificationBuffer:
+    """
+    Write-behind buffer of new notifications: they are written with one multi-row insert and one rollup upsert
+    once max_size of them are collected or max_delay passed since the first one.
+    A batch that failed to be written goes back to the front of the buffer and is retried after retry_delay,
+    it is dropped and counted in bot_dropped_notifications_total only once max_attempts writes in a row failed.
+    :param bool enabled: If False, every notification is written right away by create_notification.
+    :param int max_size: Amount of buffered notifications written at once.
+    :param float max_delay: Seconds a notification waits in the buffer at most.
+    :param int max_attempts: Failed writes in a row before the batch is dropped.
+    :param float retry_delay: Seconds before a failed batch is written again.
+    """
+
+    def __init__(self, enabled: bool = False, max_size: int = 50, max_delay: float = 0.005, max_attempts: int = 5,
+                 retry_delay: float = 1):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._buffer = []
+        self._timer = None
+        self._tasks = set()
+        self._failures = 0
+
+    async def create(self, user_id: int, household_id: int, notification_type: str):
+        """
+        :return: Returns Notification with created set, but without id while it is buffered.
+        """
+        if not self.enabled:
+            return await create_notification(user_id, household_id, notification_type)
+        notification = Notification(
+            user_id=user_id,
+            household_id=household_id,
+            notification_type=notification_type,
+            created=datetime.now(timezone.utc),
+        )
+        self._buffer.append(notification)
+        if len(self._buffer) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.max_delay, self._flush_later)
+        return notification
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await _write_notifications(batch)
+        except Exception:
+            self._failures += 1
+            if self._failures >= self.max_attempts:
+                self._failures = 0
+                dropped_notifications.inc(len(batch))
+                logger.exception(f'Dropping {len(batch)} buffered notifications after {self.max_attempts} attempts')
+                return
+            logger.exception(f'Failed to write {len(batch)} buffered notifications, retrying')
+            self._buffer[:0] = batch
+            if self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(self.retry_delay, self._flush_later)
+        else:
+            self._failures = 0
+
+    async def close(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # failed batches are retried right away, every one is either written or dropped after max_attempts
+        while self._buffer:
+            await self.flush()
+
+
+async def backfill_activity(household_id: int = None):
+    """
+    Fills the rollup from the whole notifications history, the archived part included.
+    Does nothing once the rollup has any rows of the household.
+    :param int household_id: Household to fill the rollup of, all of them if None.
+    """
+    def kept(source):
+        condition = source.c.deleted.is_(None)
+        return condition if household_id is None else and_(condition, source.c.household_id == household_id)
+
+    async with db.transaction():
+        present = db.select([ActivityRollup.user_id])
+        if household_id is not None:
+            present = present.where(ActivityRollup.household_id == household_id)
+        if await present.limit(1).gino.scalar():
+            return
+        live = Notification.__table__
+        sources = [select([
+            live.c.household_id, live.c.user_id, live.c.notification_type, live.c.created
+        ]).where(kept(live))]
+        # the archive has no model, it is partitioned and created by the migrations only
+        if await db.scalar(text("SELECT to_regclass('notifications_archive') IS NOT NULL")):
+            archive = table('notifications_archive', column('household_id'), column('user_id'),
+                            column('notification_type'), column('created'), column('deleted'))
+            sources.append(select([
+                archive.c.household_id, archive.c.user_id, archive.c.notification_type, archive.c.created
+            ]).where(kept(archive)))
+        notifications = union_all(*sources).alias('history')
+        day = cast(notifications.c.created, Date)
+        history = select([
+            notifications.c.household_id,
+            notifications.c.user_id,
+            notifications.c.notification_type,
+            day,
+            func.count(),
+        ]).group_by(notifications.c.household_id, notifications.c.user_id, notifications.c.notification_type, day)
+        await insert(ActivityRollup).from_select(
+            ['household_id', 'user_id', 'notification_type', 'day', 'amount'], history
+        ).gino.status()
@@ -3,9 +3,16 @@ from functools import partial
 
 from gino import Gino
 
+from config import settings
+
 db = Gino()
 
 
+def get_database_url():
+    return f'postgresql://{settings.database.user}:{settings.database.password}' \
+           f'@{settings.database.host}:{settings.database.port}/{settings.database.name}'
+
+
 class BaseModel(db.Model):
     __abstract__ = True
 
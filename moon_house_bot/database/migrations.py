@@ -0,0 +1,224 @@
+import logging
+from collections import namedtuple
+from datetime import date
+
+from sqlalchemy import text
+
+from config import settings
+from moon_house_bot.database.db import db
+from moon_house_bot.database.partitions import create_live_partitions, month_start
+
+logger = logging.getLogger(__name__)
+
+# arbitrary key of the advisory lock, so concurrently started processes don't migrate twice
+MIGRATIONS_LOCK_KEY = 4_617_001
+
+Migration = namedtuple('Migration', 'version name steps')
+
+
+async def _move_to_target_household():
+    # everything written before households belongs to the single flat the bot served, the one of target_chat_id
+    if not await db.scalar(text('SELECT EXISTS (SELECT 1 FROM users WHERE household_id IS NULL)')):
+        return
+    household_id = int(settings.target_chat_id)
+    await db.status(
+        text('INSERT INTO households (chat_id, created) VALUES (:household_id, now()) ON CONFLICT DO NOTHING'),
+        household_id=household_id,
+    )
+    for table in ('users', 'notifications', 'parties'):
+        await db.status(
+            text(f'UPDATE {table} SET household_id = :household_id WHERE household_id IS NULL'),
+            household_id=household_id,
+        )
+
+
+async def _create_notification_partitions():
+    first = await db.scalar(text('SELECT min(created) FROM notifications_unpartitioned'))
+    today = date.today()
+    await create_live_partitions(
+        first.date() if first else today, month_start(today, settings.notifications_retention.months_ahead)
+    )
+
+
+# steps are either plain SQL or coroutine functions, pending migrations are applied in one transaction
+MIGRATIONS = [
+    # tables are created by explicit DDL as they were when the migration shipped, never from the current models,
+    # so a fresh database goes through the same steps as an upgraded one and ends up with the same schema;
+    # IF NOT EXISTS keeps the tables the bot created before it had migrations
+    Migration(1, 'initial schema', [
+        'CREATE TABLE IF NOT EXISTS users ('
+        'chat_id integer NOT NULL, '
+        'firstname varchar NOT NULL, '
+        'lastname varchar, '
+        'is_admin boolean NOT NULL, '
+        'created timestamptz NOT NULL, '
+        'deleted timestamptz, '
+        'PRIMARY KEY (chat_id), '
+        'UNIQUE (chat_id))',
+        'CREATE TABLE IF NOT EXISTS notifications ('
+        'id serial NOT NULL, '
+        'user_id integer NOT NULL REFERENCES users (chat_id), '
+        'notification_type varchar NOT NULL, '
+        'created timestamptz NOT NULL, '
+        'deleted timestamptz, '
+        'PRIMARY KEY (id), '
+        'UNIQUE (id))',
+        'CREATE TABLE IF NOT EXISTS parties ('
+        'id serial NOT NULL, '
+        'user_id integer NOT NULL REFERENCES users (chat_id), '
+        'party_date date NOT NULL, '
+        'guests_amount integer NOT NULL, '
+        'using_sofa boolean NOT NULL, '
+        'created timestamptz NOT NULL, '
+        'deleted timestamptz, '
+        'PRIMARY KEY (id), '
+        'UNIQUE (id))',
+        'CREATE TABLE IF NOT EXISTS activity_rollup ('
+        'user_id integer NOT NULL REFERENCES users (chat_id), '
+        'notification_type varchar NOT NULL, '
+        'day date NOT NULL, '
+        'amount integer NOT NULL, '
+        'PRIMARY KEY (user_id, notification_type, day))',
+    ]),
+    Migration(2, 'partial indexes for hot notification and party queries', [
+        # trash/dishwasher/silence lookups: type equality plus a created range or ORDER BY created DESC
+        'CREATE INDEX IF NOT EXISTS ix_notifications_type_created_active '
+        'ON notifications (notification_type, created) WHERE deleted IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_parties_user_id_party_date_active '
+        'ON parties (user_id, party_date) WHERE deleted IS NULL',
+    ]),
+    Migration(3, 'unique active party per date', [
+        # keep the earliest booking of a date, the rest could only appear through the old check-then-insert race
+        'UPDATE parties SET deleted = now() '
+        'WHERE deleted IS NULL AND id NOT IN ('
+        'SELECT min(id) FROM parties WHERE deleted IS NULL GROUP BY party_date)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_parties_party_date_active '
+        'ON parties (party_date) WHERE deleted IS NULL',
+    ]),
+    Migration(4, 'backfill activity rollup', [
+        # the same as backfill_activity did then, it has moved on with the schema since
+        'INSERT INTO activity_rollup (user_id, notification_type, day, amount) '
+        'SELECT user_id, notification_type, CAST(created AS date), count(*) FROM notifications '
+        'WHERE deleted IS NULL AND NOT EXISTS (SELECT 1 FROM activity_rollup) '
+        'GROUP BY user_id, notification_type, CAST(created AS date)',
+    ]),
+    Migration(5, 'fsm states table', [
+        'CREATE TABLE IF NOT EXISTS fsm_states ('
+        'chat varchar NOT NULL, '
+        '"user" varchar NOT NULL, '
+        'state varchar, '
+        'data varchar NOT NULL, '
+        'updated timestamptz NOT NULL, '
+        'PRIMARY KEY (chat, "user"))',
+        'CREATE INDEX IF NOT EXISTS ix_fsm_states_updated ON fsm_states (updated)',
+    ]),
+    Migration(6, 'households', [
+        'CREATE TABLE IF NOT EXISTS households ('
+        'chat_id bigint NOT NULL, '
+        'title varchar, '
+        'created timestamptz NOT NULL, '
+        'deleted timestamptz, '
+        'PRIMARY KEY (chat_id), '
+        'UNIQUE (chat_id))',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS household_id bigint REFERENCES households (chat_id)',
+        'ALTER TABLE notifications ADD COLUMN IF NOT EXISTS household_id bigint REFERENCES households (chat_id)',
+        'ALTER TABLE parties ADD COLUMN IF NOT EXISTS household_id bigint REFERENCES households (chat_id)',
+        _move_to_target_household,
+        'ALTER TABLE users ALTER COLUMN household_id SET NOT NULL',
+        'ALTER TABLE notifications ALTER COLUMN household_id SET NOT NULL',
+        'ALTER TABLE parties ALTER COLUMN household_id SET NOT NULL',
+    ]),
+    Migration(7, 'household scoped indexes', [
+        # every hot query is filtered by the household first, so it leads the indexes,
+        # a date is booked once per household and the unique index also serves the upcoming parties
+        'DROP INDEX IF EXISTS ix_notifications_type_created_active',
+        'DROP INDEX IF EXISTS ux_parties_party_date_active',
+        # the parties of a user are served from the in-memory index
+        'DROP INDEX IF EXISTS ix_parties_user_id_party_date_active',
+        'CREATE INDEX IF NOT EXISTS ix_notifications_household_type_created_active '
+        'ON notifications (household_id, notification_type, created) WHERE deleted IS NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_parties_household_party_date_active '
+        'ON parties (household_id, party_date) WHERE deleted IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_users_household_id ON users (household_id)',
+    ]),
+    Migration(8, 'notifications partitioned by month', [
+        # rows are copied to a new table partitioned by created, its key has to include the partition key;
+        # the sequence and the index names are kept, so ids go on
+        'ALTER SEQUENCE notifications_id_seq OWNED BY NONE',
+        'DROP INDEX IF EXISTS ix_notifications_household_type_created_active',
+        'ALTER TABLE notifications RENAME TO notifications_unpartitioned',
+        'ALTER TABLE notifications_unpartitioned '
+        'RENAME CONSTRAINT notifications_pkey TO notifications_unpartitioned_pkey',
+        "CREATE TABLE notifications ("
+        "id integer NOT NULL DEFAULT nextval('notifications_id_seq'), "
+        "created timestamptz NOT NULL, "
+        "user_id integer NOT NULL REFERENCES users (chat_id), "
+        "household_id bigint NOT NULL REFERENCES households (chat_id), "
+        "notification_type varchar NOT NULL, "
+        "deleted timestamptz, "
+        "PRIMARY KEY (id, created)) PARTITION BY RANGE (created)",
+        # catches rows beyond the monthly partitions, the retention job creates them ahead so it stays empty
+        'CREATE TABLE notifications_default PARTITION OF notifications DEFAULT',
+        _create_notification_partitions,
+        'INSERT INTO notifications (id, created, user_id, household_id, notification_type, deleted) '
+        'SELECT id, created, user_id, household_id, notification_type, deleted FROM notifications_unpartitioned',
+        'DROP TABLE notifications_unpartitioned',
+        'ALTER SEQUENCE notifications_id_seq OWNED BY notifications.id',
+        'CREATE INDEX ix_notifications_household_type_created_active '
+        'ON notifications (household_id, notification_type, created) WHERE deleted IS NULL',
+        # old and soft-deleted rows are moved here by the retention job, split by years
+        'CREATE TABLE notifications_archive (LIKE notifications) PARTITION BY RANGE (created)',
+        'CREATE TABLE notifications_archive_default PARTITION OF notifications_archive DEFAULT',
+    ]),
+    Migration(9, 'household in the activity rollup key', [
+        # a user belongs to one household, so the existing rows are theirs
+        'ALTER TABLE activity_rollup ADD COLUMN household_id bigint REFERENCES households (chat_id)',
+        'UPDATE activity_rollup SET household_id = users.household_id '
+        'FROM users WHERE users.chat_id = activity_rollup.user_id',
+        'ALTER TABLE activity_rollup ALTER COLUMN household_id SET NOT NULL',
+        'ALTER TABLE activity_rollup DROP CONSTRAINT activity_rollup_pkey',
+        'ALTER TABLE activity_rollup ADD PRIMARY KEY (household_id, user_id, notification_type, day)',
+    ]),
+]
+
+
+async def run_steps(migration: Migration):
+    for step in migration.steps:
+        if isinstance(step, str):
+            await db.status(text(step))
+        else:
+            await step()
+
+
+async def _apply(migration: Migration):
+    await run_steps(migration)
+    await db.status(
+        text('INSERT INTO schema_migrations (version, name) VALUES (:version, :name)'),
+        version=migration.version,
+        name=migration.name,
+    )
+
+
+async def migrate(target: int = None):
+    """
+    Applies not yet applied migrations up to the target version (the latest one if None).
+    :param int target: Version to stop at.
+    :return: Returns list of applied versions.
+    """
+    applied_now = []
+    async with db.transaction():
+        await db.status(text('SELECT pg_advisory_xact_lock(:key)'), key=MIGRATIONS_LOCK_KEY)
+        await db.status(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version integer PRIMARY KEY, '
+            'name varchar NOT NULL, '
+            'applied timestamptz NOT NULL DEFAULT now())'
+        ))
+        applied = {row[0] for row in await db.all(text('SELECT version FROM schema_migrations'))}
+        for migration in MIGRATIONS:
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            logger.info(f'Applying migration {migration.version}: {migration.name}')
+            await _apply(migration)
+            applied_now.append(migration.version)
+    return applied_now
@@ -1,10 +1,22 @@
+from datetime import datetime, timezone
+from functools import partial
+
 from moon_house_bot.database.db import BaseModel, db
 
 
+class Household(BaseModel):
+    __tablename__ = 'households'
+
+    # id of the group chat of the flat, supergroup ids don't fit into integer
+    chat_id = db.Column(db.BigInteger(), primary_key=True, unique=True, autoincrement=False)
+    title = db.Column(db.String())
+
+
 class User(BaseModel):
     __tablename__ = 'users'
 
     chat_id = db.Column(db.Integer(), primary_key=True, unique=True, autoincrement=False)
+    household_id = db.Column(db.ForeignKey(F'{Household.__tablename__}.chat_id'), nullable=False)
     firstname = db.Column(db.String(), nullable=False)
     lastname = db.Column(db.String())
     is_admin = db.Column(db.Boolean(), nullable=False, default=False)
@@ -13,8 +25,11 @@ class User(BaseModel):
 class Notification(BaseModel):
     __tablename__ = 'notifications'
 
-    id = db.Column(db.Integer(), primary_key=True, unique=True)
+    # the table is partitioned by created since migration 8, so the key of a partitioned table has to include it
+    id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
+    created = db.Column(db.DateTime(True), primary_key=True, default=partial(datetime.now, timezone.utc))
     user_id = db.Column(db.ForeignKey(F'{User.__tablename__}.chat_id'), nullable=False)
+    household_id = db.Column(db.ForeignKey(F'{Household.__tablename__}.chat_id'), nullable=False)
     notification_type = db.Column(db.String(), nullable=False)
 
 
@@ -23,6 +38,27 @@ class Party(BaseModel):
 
     id = db.Column(db.Integer(), primary_key=True, unique=True)
     user_id = db.Column(db.ForeignKey(F'{User.__tablename__}.chat_id'), nullable=False)
+    household_id = db.Column(db.ForeignKey(F'{Household.__tablename__}.chat_id'), nullable=False)
     party_date = db.Column(db.Date(), nullable=False)
     guests_amount = db.Column(db.Integer(), nullable=False)
     using_sofa = db.Column(db.Boolean(), nullable=False)
+
+
+class ActivityRollup(db.Model):
+    __tablename__ = 'activity_rollup'
+
+    household_id = db.Column(db.ForeignKey(F'{Household.__tablename__}.chat_id'), primary_key=True)
+    user_id = db.Column(db.ForeignKey(F'{User.__tablename__}.chat_id'), primary_key=True)
+    notification_type = db.Column(db.String(), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True)
+    amount = db.Column(db.Integer(), nullable=False, default=0)
+
+
+class FsmState(db.Model):
+    __tablename__ = 'fsm_states'
+
+    chat = db.Column(db.String(), primary_key=True)
+    user = db.Column(db.String(), primary_key=True)
+    state = db.Column(db.String())
+    data = db.Column(db.String(), nullable=False, default='{}')
+    updated = db.Column(db.DateTime(True), nullable=False, index=True)
@@ -0,0 +1,101 @@
+import logging
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+
+from moon_house_bot.database.db import db
+
+logger = logging.getLogger(__name__)
+
+LIVE_PARTITION = re.compile(r'^notifications_p(\d{4})(\d{2})$')
+
+
+def month_start(day: date, shift: int = 0):
+    """
+    :param int shift: Months to move by, negative ones move back.
+    :return: Returns date of the first day of the month.
+    """
+    months = day.year * 12 + day.month - 1 + shift
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _bound(day: date):
+    # partition bounds are compared to timestamptz, so they are fixed in UTC rather than the session time zone
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def partition_sql(name: str, parent: str, start: date, end: date):
+    """
+    DDL of a range partition. Postgres takes no parameters in DDL, so the bounds are rendered as literals,
+    they only ever come from date values.
+    """
+    return (
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent} "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d} 00:00:00+00') TO ('{end:%Y-%m-%d} 00:00:00+00')"
+    )
+
+
+async def create_live_partitions(first_month: date, last_month: date):
+    """
+    Creates the monthly partitions of notifications from the first to the last month, both included.
+    """
+    month = month_start(first_month)
+    while month <= last_month:
+        following = month_start(month, 1)
+        await db.status(partition_sql(f'notifications_p{month:%Y%m}', 'notifications', month, following))
+        month = following
+
+
+async def create_archive_partitions(first_year: int, last_year: int):
+    for year in range(first_year, last_year + 1):
+        await db.status(partition_sql(
+            f'notifications_archive_p{year}', 'notifications_archive', date(year, 1, 1), date(year + 1, 1, 1)
+        ))
+
+
+async def _live_partitions():
+    rows = await db.all(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'notifications'"
+    ))
+    partitions = {}
+    for (name,) in rows:
+        match = LIVE_PARTITION.match(name)
+        if match:
+            partitions[name] = date(int(match.group(1)), int(match.group(2)), 1)
+    return partitions
+
+
+async def archive_notifications(live_months: int = 3, months_ahead: int = 2):
+    """
+    Moves soft-deleted notifications and the ones older than live_months whole months to notifications_archive,
+    drops the emptied monthly partitions and creates the ones of the next months_ahead months,
+    so new rows never end up in the default partition.
+    :return: Returns int amount of moved rows.
+    """
+    today = date.today()
+    cutoff = _bound(month_start(today, -live_months))
+    await create_live_partitions(month_start(today), month_start(today, months_ahead))
+    async with db.transaction():
+        oldest = await db.scalar(text(
+            'SELECT min(created) FROM notifications WHERE deleted IS NOT NULL OR created < :cutoff'
+        ), cutoff=cutoff)
+        if oldest is None:
+            moved = 0
+        else:
+            await create_archive_partitions(oldest.year, today.year)
+            # the archive is created LIKE notifications, so the columns are in the same order
+            moved = await db.scalar(text(
+                'WITH moved AS ('
+                'DELETE FROM notifications WHERE deleted IS NOT NULL OR created < :cutoff RETURNING *'
+                '), archived AS (INSERT INTO notifications_archive SELECT * FROM moved RETURNING 1) '
+                'SELECT count(*) FROM archived'
+            ), cutoff=cutoff)
+        for name, month in (await _live_partitions()).items():
+            if _bound(month_start(month, 1)) <= cutoff:
+                await db.status(text(f'DROP TABLE {name}'))
+    logger.info(f'Archived {moved} notifications older than {cutoff:%Y-%m} or deleted')
+    return moved
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import deque
+
+from gino.dialects.asyncpg import Pool
+from sqlalchemy import text
+
+from moon_house_bot.database.db import db
+from moon_house_bot.metrics import percentile
+from moon_house_bot.tracing import span
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.max_in_use = 0
+        self.waits = deque(maxlen=1000)
+
+    @property
+    def stats(self):
+        return {
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'max_in_use': self.max_in_use,
+            'wait_p50': percentile(self.waits, 50),
+            'wait_p95': percentile(self.waits, 95),
+            'wait_max': max(self.waits, default=0.0),
+        }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(Pool):
+    """
+    asyncpg pool of gino counting connection checkouts and the time spent waiting for them.
+    Passed to set_bind as pool_class.
+    """
+
+    async def acquire(self, *, timeout=None):
+        started = time.monotonic()
+        pool_stats.waiting += 1
+        try:
+            with span('db.acquire'):
+                connection = await super().acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            pool_stats.waiting -= 1
+        pool_stats.waits.append(time.monotonic() - started)
+        pool_stats.checkouts += 1
+        pool_stats.in_use += 1
+        pool_stats.max_in_use = max(pool_stats.max_in_use, pool_stats.in_use)
+        return connection
+
+    async def release(self, conn):
+        pool_stats.in_use -= 1
+        await super().release(conn)
+
+
+async def warm_up_pool(size: int):
+    """
+    Checks out the given amount of connections at once, so they are open and alive before the first update.
+    """
+    connections = [await db.acquire() for _ in range(size)]
+    try:
+        for connection in connections:
+            await connection.scalar(text('SELECT 1'))
+    finally:
+        for connection in connections:
+            await connection.release()
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import re
+import time
+
+from gino.dialects.asyncpg import DBAPICursor, Transaction
+
+from config import settings
+from moon_house_bot.database.db import db
+from moon_house_bot.metrics import db_queries, db_query_latency
+from moon_house_bot.tracing import span
+
+logger = logging.getLogger(__name__)
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_PARAMETER_LIST = re.compile(r'\$\?(?:\s*,\s*\$\?)+')
+# texts of IN lists of every length are different statements, so the cache is dropped once it grows that big
+MAX_CACHED_SHAPES = 10000
+_shapes = {}
+
+
+def query_shape(query: str):
+    """
+    The SQL text without extra whitespace, with literals and parameters replaced by ? and
+    parameter lists of any length, like the ones of IN, collapsed into one.
+    """
+    shape = _shapes.get(query)
+    if shape is None:
+        if len(_shapes) >= MAX_CACHED_SHAPES:
+            _shapes.clear()
+        shape = _PARAMETER_LIST.sub('$?, ...', _LITERAL.sub('?', ' '.join(query.split())))
+        _shapes[query] = shape
+    return shape
+
+
+class ShapeStats:
+    __slots__ = ('shape', 'count', 'total', 'max', 'slow', 'plan', 'explained')
+
+    def __init__(self, shape: str):
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.plan = None
+        self.explained = None
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class QueryStats:
+    """
+    Timing of every query shape executed by this process. The plan of a statement slower than slow_query
+    is captured in the background, one statement at a time and once per explain_interval for a shape,
+    with EXPLAIN (ANALYZE, BUFFERS) for reads and the estimated plan only for writes.
+    :param float slow_query: Seconds a statement has to take to be explained.
+    :param int explain_interval: Seconds before the plan of a shape is captured again.
+    :param float explain_timeout: Seconds the EXPLAIN may take, ANALYZE runs the statement once more.
+    :param int top: Amount of shapes shown by the admin command.
+    """
+    _EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+    _READ = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+    # data-modifying CTEs and row locks of a read
+    _WRITES = re.compile(r'\b(INSERT|UPDATE|DELETE|SHARE)\b', re.IGNORECASE)
+
+    def __init__(self, slow_query: float = 0.1, explain_interval: int = 600, explain_timeout: float = 5,
+                 top: int = 10):
+        self.slow_query = slow_query
+        self.explain_interval = explain_interval
+        self.explain_timeout = explain_timeout
+        self.top = top
+        self.shapes = {}
+        self._explaining = None
+
+    def observe(self, shape: str, query: str, args, duration: float, many: bool = False):
+        stats = self.shapes.get(shape)
+        if stats is None:
+            stats = self.shapes[shape] = ShapeStats(shape)
+        stats.count += 1
+        stats.total += duration
+        stats.max = max(stats.max, duration)
+        if duration < self.slow_query:
+            return
+        stats.slow += 1
+        now = time.monotonic()
+        explain = self.explain_command(query)
+        if many or self._explaining or explain is None:
+            return
+        if stats.explained is None or now - stats.explained >= self.explain_interval:
+            stats.explained = now
+            self._explaining = asyncio.ensure_future(self._explain(stats, explain, query, args))
+
+    @classmethod
+    def explain_command(cls, query: str):
+        """
+        ANALYZE executes the statement once more, so only plain reads are analyzed: writes would take row locks
+        on the hot rows again and advance sequences, whatever the rollback. Writes get the estimated plan only.
+        Statements of pg_ functions, like advisory locks, are not explained at all.
+        :return: Returns str EXPLAIN command to prefix the statement with or None.
+        """
+        if 'pg_' in query or not cls._EXPLAINABLE.match(query):
+            return None
+        if cls._READ.match(query) and not cls._WRITES.search(query):
+            return 'EXPLAIN (ANALYZE, BUFFERS)'
+        return 'EXPLAIN'
+
+    async def _explain(self, stats: ShapeStats, explain: str, query: str, args):
+        try:
+            async with db.acquire() as connection:
+                raw = connection.raw_connection
+                transaction = raw.transaction()
+                await transaction.start()
+                try:
+                    await raw.execute(f'SET LOCAL statement_timeout = {int(self.explain_timeout * 1000)}')
+                    rows = await raw.fetch(f'{explain} {query}', *args)
+                finally:
+                    await transaction.rollback()
+            stats.plan = '\n'.join(row[0] for row in rows)
+        except Exception:
+            logger.exception(f'Failed to explain {stats.shape}')
+        finally:
+            self._explaining = None
+
+    def slowest(self, limit: int = None):
+        """
+        :return: Returns list of ShapeStats ordered by mean duration, the slowest first.
+        """
+        return sorted(self.shapes.values(), key=lambda s: s.mean, reverse=True)[:limit or self.top]
+
+
+query_stats = QueryStats(**settings.slow_queries)
+
+
+class InstrumentedCursor(DBAPICursor):
+    async def async_execute(self, query, timeout, args, limit=0, many=False):
+        shape = query_shape(query)
+        started = time.monotonic()
+        try:
+            with span('query', sql=shape):
+                return await super().async_execute(query, timeout, args, limit, many)
+        finally:
+            duration = time.monotonic() - started
+            db_queries.inc(query=shape)
+            db_query_latency.observe(duration, query=shape)
+            query_stats.observe(shape, query, args, duration, many)
+
+
+class TracedTransaction(Transaction):
+    # BEGIN and COMMIT are sent by asyncpg itself, not through the cursor
+    async def begin(self):
+        with span('transaction.begin'):
+            await super().begin()
+
+    async def commit(self):
+        with span('transaction.commit'):
+            await super().commit()
+
+    async def rollback(self):
+        with span('transaction.rollback'):
+            await super().rollback()
+
+
+def _traced_transaction(raw_conn, args, kwargs):
+    return TracedTransaction(raw_conn.transaction(*args, **kwargs))
+
+
+def instrument_engine(engine):
+    # the dialect cursor class is looked up on every connection checkout
+    engine.dialect.cursor_cls = InstrumentedCursor
+    engine.dialect.transaction = _traced_transaction
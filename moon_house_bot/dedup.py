@@ -0,0 +1,47 @@
+from collections import deque
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from moon_house_bot.metrics import duplicate_updates
+
+
+class RecentUpdates:
+    """
+    Bounded set of the update ids seen last, Telegram re-delivers an update when the webhook answers too late.
+    :param int max_size: Amount of ids kept, the oldest are forgotten first.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._ids = set()
+        self._order = deque(maxlen=max_size)
+
+    def seen(self, update_id: int):
+        """
+        Remembers the id.
+        :return: Returns True if the id was already seen, the update is a duplicate then.
+        """
+        if update_id in self._ids:
+            duplicate_updates.inc()
+            return True
+        if len(self._order) == self.max_size:
+            self._ids.discard(self._order[0])
+        self._order.append(update_id)
+        self._ids.add(update_id)
+        return False
+
+
+class DeduplicationMiddleware(BaseMiddleware):
+    """
+    Drops re-delivered updates before any handler runs.
+    """
+
+    def __init__(self, recent: RecentUpdates):
+        super().__init__()
+        self.recent = recent
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if self.recent.seen(update.update_id):
+            raise CancelHandler()
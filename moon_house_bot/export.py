@@ -0,0 +1,175 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+from datetime import date
+
+from sqlalchemy import column, select, table, union_all
+
+from moon_house_bot.database import Notification, Party, User, db
+from moon_house_bot.outbound import OutboundDispatcher
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl')
+NOTIFICATION_COLUMNS = ('created', 'notification_type', 'user_id', 'firstname', 'lastname', 'deleted')
+PARTY_COLUMNS = (
+    'party_date', 'guests_amount', 'using_sofa', 'user_id', 'firstname', 'lastname', 'created', 'deleted'
+)
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def notifications_query(household_id: int):
+    # the archive has no model, it is partitioned and created by the migrations only
+    archive = table('notifications_archive', *(column(c) for c in (
+        'created', 'notification_type', 'user_id', 'household_id', 'deleted'
+    )))
+    history = union_all(
+        select([Notification.created, Notification.notification_type, Notification.user_id, Notification.deleted])
+        .where(Notification.household_id == household_id),
+        select([archive.c.created, archive.c.notification_type, archive.c.user_id, archive.c.deleted])
+        .where(archive.c.household_id == household_id),
+    ).alias('history')
+    return select([
+        history.c.created,
+        history.c.notification_type,
+        history.c.user_id,
+        User.firstname,
+        User.lastname,
+        history.c.deleted,
+    ]).select_from(
+        history.join(User, User.chat_id == history.c.user_id)
+    ).order_by(history.c.created)
+
+
+def parties_query(household_id: int):
+    return select([
+        Party.party_date,
+        Party.guests_amount,
+        Party.using_sofa,
+        Party.user_id,
+        User.firstname,
+        User.lastname,
+        Party.created,
+        Party.deleted,
+    ]).select_from(Party.join(User)).where(
+        Party.household_id == household_id
+    ).order_by(Party.party_date, Party.created)
+
+
+class _Chunks:
+    """
+    Rows formatted into a file, uploaded and started anew once it is chunk_size characters long.
+    """
+
+    def __init__(self, name: str, fmt: str, columns: tuple, chunk_size: int, upload):
+        self.name = name
+        self.fmt = fmt
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.upload = upload
+        self.uploaded = 0
+        self.rows = 0
+        self._start()
+
+    def _start(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer) if self.fmt == 'csv' else None
+        self._empty = True
+        if self._writer:
+            # every file is complete on its own
+            self._writer.writerow(self.columns)
+
+    def write(self, rows):
+        for row in rows:
+            values = [_plain(value) for value in row]
+            if self._writer:
+                self._writer.writerow(values)
+            else:
+                self._buffer.write(json.dumps(dict(zip(self.columns, values)), ensure_ascii=False) + '\n')
+        self.rows += len(rows)
+        self._empty = self._empty and not rows
+
+    async def flush(self, final: bool = False):
+        # Telegram doesn't take empty files, a file with the CSV header only isn't worth sending either
+        if self._empty or (not final and self._buffer.tell() < self.chunk_size):
+            return
+        self.uploaded += 1
+        data = self._buffer.getvalue().encode()
+        self._start()
+        await self.upload(f'{self.name}_{self.uploaded}.{self.fmt}', data)
+
+
+class HistoryExport:
+    """
+    Streams the whole notifications and parties history of a household, the archived part included,
+    as CSV or JSON Lines files sent to a chat. Rows are read through a server-side cursor,
+    so only fetch_size rows and one file of chunk_size characters are held in memory however long the history is.
+    One export runs at a time, it keeps a pool connection and a transaction open until the last file is sent.
+    :param OutboundDispatcher outbound: Dispatcher the files are sent with, within the flood limits.
+    :param int fetch_size: Rows fetched from the cursor at once.
+    :param int chunk_size: Characters a file grows to before it is sent, Telegram takes up to 50 MB from bots.
+    """
+
+    def __init__(self, outbound: OutboundDispatcher, fetch_size: int = 1000, chunk_size: int = 10_000_000):
+        self.outbound = outbound
+        self.fetch_size = fetch_size
+        self.chunk_size = chunk_size
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, household_id: int, fmt: str, chat_id: int):
+        """
+        Starts the export in the background, so the updates of the chat aren't held up meanwhile.
+        :return: Returns False if another export is still running.
+        """
+        if self.running:
+            return False
+        self._task = asyncio.ensure_future(self._run(household_id, fmt, chat_id))
+        return True
+
+    async def _run(self, household_id: int, fmt: str, chat_id: int):
+        try:
+            rows = await self.export(household_id, fmt, chat_id)
+            logger.info(f'Exported {rows} rows of household {household_id} as {fmt}')
+            self.outbound.send_message(chat_id, f'История выгружена, записей: {rows}')
+        except Exception:
+            logger.exception(f'Failed to export the history of household {household_id}')
+            self.outbound.send_message(chat_id, 'Не удалось выгрузить историю')
+
+    async def export(self, household_id: int, fmt: str, chat_id: int):
+        """
+        :return: Returns int amount of exported rows.
+        """
+        async def upload(filename: str, data: bytes):
+            # waiting for the upload holds the next rows back, so files don't pile up in the outbound queue
+            await self.outbound.send_document(chat_id, data, filename)
+
+        exported = 0
+        async with db.transaction():
+            for name, query, columns in (
+                ('notifications', notifications_query(household_id), NOTIFICATION_COLUMNS),
+                ('parties', parties_query(household_id), PARTY_COLUMNS),
+            ):
+                chunks = _Chunks(name, fmt, columns, self.chunk_size, upload)
+                cursor = await query.gino.iterate()
+                while True:
+                    rows = await cursor.many(self.fetch_size)
+                    chunks.write(rows)
+                    await chunks.flush(final=not rows)
+                    if not rows:
+                        break
+                exported += chunks.rows
+        return exported
+
+    async def close(self):
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -0,0 +1,150 @@
+import copy
+import json
+import typing
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
+
+from moon_house_bot.database import FsmState
+
+
+def _encode(value):
+    # party dates are kept in the FSM data between the steps of a booking
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _decode(value: dict):
+    if '__date__' in value:
+        return date.fromisoformat(value['__date__'])
+    return value
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM states storage in the bot database with an in-memory write-through cache.
+    States not touched for ttl seconds are considered abandoned and dropped.
+    :param int ttl: Seconds an untouched state lives.
+    :param int cache_size: Amount of chat/user records kept in memory.
+    """
+
+    def __init__(self, ttl: int = 86400, cache_size: int = 10000):
+        self.ttl = timedelta(seconds=ttl)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    async def close(self):
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    def _is_expired(self, updated: datetime):
+        return updated is not None and updated + self.ttl < datetime.now().astimezone()
+
+    async def _load(self, chat, user):
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._cache.get(key)
+        if record is None:
+            row = await FsmState.query.where(and_(FsmState.chat == key[0], FsmState.user == key[1])).gino.first()
+            record = {'state': None, 'data': {}, 'updated': None}
+            if row and not self._is_expired(row.updated):
+                record = {'state': row.state, 'data': json.loads(row.data, object_hook=_decode), 'updated': row.updated}
+        elif self._is_expired(record['updated']):
+            record = {'state': None, 'data': {}, 'updated': None}
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return key, record
+
+    async def _save(self, key, record):
+        try:
+            await self._write(key, record)
+        except Exception:
+            # the cached record is already changed, so the next read has to go to the database
+            self._cache.pop(key, None)
+            raise
+
+    async def _write(self, key, record):
+        record['updated'] = datetime.now().astimezone()
+        if record['state'] is None and not record['data']:
+            await FsmState.delete.where(and_(FsmState.chat == key[0], FsmState.user == key[1])).gino.status()
+            return
+        statement = insert(FsmState).values(
+            chat=key[0],
+            user=key[1],
+            state=record['state'],
+            data=json.dumps(record['data'], default=_encode),
+            updated=record['updated'],
+        )
+        await statement.on_conflict_do_update(
+            index_elements=[FsmState.chat, FsmState.user],
+            set_={
+                'state': statement.excluded.state,
+                'data': statement.excluded.data,
+                'updated': statement.excluded.updated,
+            },
+        ).gino.status()
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._load(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._load(chat, user)
+        return copy.deepcopy(record['data'] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key, record = await self._load(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._save(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._load(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        await self._save(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key, record = await self._load(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        await self._save(key, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._load(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        await self._save(key, record)
+
+    async def purge_expired(self):
+        """
+        Removes abandoned states from the database and the cache.
+        """
+        expired = datetime.now().astimezone() - self.ttl
+        await FsmState.delete.where(FsmState.updated < expired).gino.status()
+        for key in [k for k, r in self._cache.items() if r['updated'] and r['updated'] < expired]:
+            del self._cache[key]
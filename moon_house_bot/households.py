@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.postgresql import insert
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import Household, db
+
+
+class Households:
+    """
+    Group chats registered as households, kept in memory so messages of unknown groups are dropped without the DB.
+    With several bot processes every registered household is broadcast to the others.
+    :param Broadcast broadcast: Channel to the other bot processes.
+    """
+    channel = 'households'
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self._chat_ids = set()
+        broadcast.listen(self.channel, self._chat_ids.add)
+
+    async def load(self):
+        rows = await db.select([Household.chat_id]).where(Household.deleted.is_(None)).gino.all()
+        # updated in place, the broadcast listener is bound to this set
+        self._chat_ids.clear()
+        self._chat_ids.update(row[0] for row in rows)
+
+    def __contains__(self, chat_id: int):
+        return chat_id in self._chat_ids
+
+    def __iter__(self):
+        return iter(list(self._chat_ids))
+
+    def __len__(self):
+        return len(self._chat_ids)
+
+    async def register(self, chat_id: int, title: str = None):
+        """
+        Registers the group chat as a household, a removed one is restored.
+        """
+        statement = insert(Household).values(chat_id=chat_id, title=title, created=datetime.now(timezone.utc))
+        await statement.on_conflict_do_update(
+            index_elements=[Household.chat_id],
+            set_={'title': statement.excluded.title, 'deleted': None},
+        ).gino.status()
+        self._chat_ids.add(chat_id)
+        await self.broadcast.notify(self.channel, chat_id)
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import CancelHandler, Handler, SkipHandler
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+
+from moon_house_bot.database import FsmState, db
+from moon_house_bot.metrics import (
+    fsm_states,
+    handler_latency,
+    handler_requests,
+    scheduler_job_errors,
+    scheduler_job_lag,
+    telegram_api_errors,
+    telegram_api_latency,
+)
+from moon_house_bot.tracing import UpdateTracer, merged_span, span
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.monotonic()
+        try:
+            with span('api', method=method):
+                return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            telegram_api_errors.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            telegram_api_latency.observe(time.monotonic() - started, method=method)
+
+
+def _timed_handler(handler):
+    name = handler.__name__
+
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        status = 'ok'
+        try:
+            with span('handler', handler=name):
+                return await handler(*args, **kwargs)
+        except (SkipHandler, CancelHandler):
+            status = 'skipped'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            handler_requests.inc(handler=name, status=status)
+            handler_latency.observe(time.monotonic() - started, handler=name)
+
+    return wrapper
+
+
+def _traced_filter(filter_obj):
+    check, is_async = filter_obj.filter, filter_obj.is_async
+
+    async def wrapper(*args, **kwargs):
+        with merged_span('filters'):
+            return await check(*args, **kwargs) if is_async else check(*args, **kwargs)
+
+    filter_obj.filter, filter_obj.is_async = wrapper, True
+
+
+def instrument_dispatcher(dp, tracer: UpdateTracer = None):
+    """
+    Wraps every registered handler with timing. Has to be called after all handlers are registered.
+    The spec aiogram passes arguments by was taken at registration, so the wrapper gets the same ones.
+    With an enabled tracer every update is traced and filter checks are timed as well,
+    otherwise the filters and the update processing are left as they are.
+    """
+    tracing = tracer is not None and tracer.enabled
+    for handler in vars(dp).values():
+        if not isinstance(handler, Handler):
+            continue
+        for handler_obj in handler.handlers:
+            if handler is dp.updates_handler:
+                if tracing:
+                    handler_obj.handler = tracer.trace(handler_obj.handler)
+                continue
+            handler_obj.handler = _timed_handler(handler_obj.handler)
+            if tracing:
+                for filter_obj in handler_obj.filters or ():
+                    _traced_filter(filter_obj)
+
+
+def _on_job_event(event):
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.now(timezone.utc)
+        for run_time in event.scheduled_run_times:
+            scheduler_job_lag.observe((now - run_time).total_seconds(), job=event.job_id)
+    else:
+        scheduler_job_errors.inc(job=event.job_id, event='error' if event.code == EVENT_JOB_ERROR else 'missed')
+
+
+def instrument_scheduler(scheduler):
+    scheduler.add_listener(_on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+
+async def collect_fsm_states():
+    rows = await db.select([FsmState.state, db.func.count()]).where(
+        FsmState.state.isnot(None)
+    ).group_by(FsmState.state).gino.all()
+    fsm_states.clear()
+    for state, amount in rows:
+        fsm_states.set(amount, state=state)
+
+
+async def refresh_fsm_states(interval: float):
+    """
+    Counts the FSM states every interval seconds, scrapes are served the last counts and don't query the DB,
+    however many scrapers there are.
+    """
+    while True:
+        try:
+            await collect_fsm_states()
+        except Exception:
+            logger.exception('Failed to count FSM states')
+        await asyncio.sleep(interval)
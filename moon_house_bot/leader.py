@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from moon_house_bot.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """
+    Elects a single leader among the bot processes with a session-level Postgres advisory lock.
+    The lock is held by a dedicated connection, so it is released as soon as the leader process dies
+    and one of the others takes over on its next attempt.
+    :param int key: Advisory lock key.
+    :param float retry_interval: Seconds between attempts to take the lock or to check it is still held.
+    """
+
+    def __init__(self, key: int, retry_interval: float = 30):
+        self.key = key
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._connection = None
+        self._task = None
+
+    async def start(self, on_elected, on_lost=None):
+        """
+        Tries to become the leader right away and keeps trying in background otherwise.
+        :param on_elected: Function called once the lock is taken.
+        :param on_lost: Function called if the lock connection breaks.
+        """
+        await self._try_acquire(on_elected)
+        self._task = asyncio.ensure_future(self._watch(on_elected, on_lost))
+
+    async def _try_acquire(self, on_elected):
+        connection = await db.acquire(reuse=False)
+        if await connection.scalar(text('SELECT pg_try_advisory_lock(:key)'), key=self.key):
+            self._connection = connection
+            self.is_leader = True
+            logger.info(f'Became the leader for lock {self.key}')
+            on_elected()
+        else:
+            await connection.release()
+
+    async def _watch(self, on_elected, on_lost):
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            try:
+                if not self.is_leader:
+                    await self._try_acquire(on_elected)
+                else:
+                    await self._connection.scalar(text('SELECT 1'))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f'Lost leadership for lock {self.key}')
+                if self.is_leader:
+                    self.is_leader = False
+                    connection, self._connection = self._connection, None
+                    await asyncio.gather(connection.release(), return_exceptions=True)
+                    if on_lost:
+                        on_lost()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._connection:
+            # the connection goes back to the pool, so the session lock has to be released explicitly
+            await self._connection.scalar(text('SELECT pg_advisory_unlock(:key)'), key=self.key)
+            await self._connection.release()
+            self._connection = None
+            self.is_leader = False
@@ -0,0 +1,53 @@
+import asyncio
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+async def fetch_pending_updates(bot, handle_batch, limit: int = 100):
+    """
+    Takes the updates Telegram kept while the bot was down, works only while no webhook is set.
+    A batch is confirmed by the next request, so it is handled before the next one is fetched.
+    :param handle_batch: Coroutine function getting a list of raw updates in the order they came.
+    :return: Returns int amount of updates.
+    """
+    offset, amount = None, 0
+    while True:
+        updates = await bot.get_updates(offset=offset, limit=limit, timeout=0)
+        if not updates:
+            return amount
+        await handle_batch([update.to_python() for update in updates])
+        amount += len(updates)
+        offset = updates[-1].update_id + 1
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """
+    Counts updates being processed, so shutdown can wait for them. Has to be set up after the middlewares
+    cancelling updates in pre_process_update, otherwise an update it counted may never be counted out.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        self.in_flight += 1
+        self._idle.clear()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        self.in_flight -= 1
+        if not self.in_flight:
+            self._idle.set()
+
+    async def wait_idle(self, timeout: float):
+        """
+        :return: Returns int amount of updates still processed after the timeout.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.in_flight
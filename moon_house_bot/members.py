@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy import and_
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import User
+
+
+class MemberCache:
+    """
+    In-process cache of active users keyed by chat_id.
+    Absent users are cached too, so strangers spamming the bot don't hit the DB either.
+    With several bot processes every joined, changed or removed user is broadcast and the others drop
+    their entry, so a missed notification leaves an entry stale for ttl (negative_ttl if it is absent) at most.
+    :param Broadcast broadcast: Channel to the other bot processes.
+    :param int ttl: Seconds an entry stays valid.
+    :param int max_size: Amount of entries kept, least recently used are evicted first.
+    :param int negative_ttl: Seconds an absent user stays cached.
+    """
+    channel = 'members'
+
+    def __init__(self, broadcast: Broadcast, ttl: int = 300, max_size: int = 1000, negative_ttl: int = 30):
+        self.broadcast = broadcast
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._members = OrderedDict()
+        broadcast.listen(self.channel, self.discard)
+
+    async def load(self):
+        users = await User.query.where(User.deleted.is_(None)).limit(self.max_size).gino.all()
+        self._members.clear()
+        for user in users:
+            self.set(user.chat_id, user)
+
+    async def get(self, chat_id: int):
+        entry = self._members.get(chat_id)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            self._members.move_to_end(chat_id)
+            return entry[0]
+
+        self.misses += 1
+        user = await User.query.where(and_(
+            User.chat_id == chat_id,
+            User.deleted.is_(None)
+        )).gino.first()
+        self.set(chat_id, user)
+        return user
+
+    def set(self, chat_id: int, user: User = None):
+        self._members[chat_id] = (user, time.monotonic() + (self.ttl if user else self.negative_ttl))
+        self._members.move_to_end(chat_id)
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+
+    def discard(self, chat_id: int):
+        self._members.pop(chat_id, None)
+
+    async def put(self, user: User):
+        """
+        Caches a joined or restored user, the other processes read it anew.
+        """
+        self.set(user.chat_id, user)
+        await self.broadcast.notify(self.channel, user.chat_id)
+
+    async def remove(self, chat_id: int):
+        self.discard(chat_id)
+        await self.broadcast.notify(self.channel, chat_id)
+
+    @property
+    def stats(self):
+        return {'size': len(self._members), 'hits': self.hits, 'misses': self.misses}
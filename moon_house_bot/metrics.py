@@ -0,0 +1,204 @@
+from aiohttp import web
+
+# seconds, from a cache hit to a slow aggregation or a Bot API call under flood control
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def percentile(samples, percent: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # one counter per bucket, then sum and count
+            counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _samples(self):
+        lines = []
+        for key, counts in self._values.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", bound)])} {count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {counts[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process rendered in the Prometheus text format.
+    Collectors are coroutine functions called before every render to refresh gauges.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    async def render(self):
+        for collector in self.collectors:
+            await collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_requests = registry.counter(
+    'bot_handler_requests_total', 'Updates handled by a handler', ('handler', 'status')
+)
+handler_latency = registry.histogram(
+    'bot_handler_latency_seconds', 'Time spent in a handler', ('handler',)
+)
+db_queries = registry.counter(
+    'bot_db_queries_total', 'Executed DB statements by query shape', ('query',)
+)
+db_query_latency = registry.histogram(
+    'bot_db_query_seconds', 'DB statement execution time by query shape', ('query',)
+)
+telegram_api_latency = registry.histogram(
+    'bot_telegram_api_seconds', 'Bot API call time', ('method',)
+)
+telegram_api_errors = registry.counter(
+    'bot_telegram_api_errors_total', 'Failed Bot API calls', ('method', 'error')
+)
+fsm_states = registry.gauge(
+    'bot_fsm_states', 'Users currently in an FSM state', ('state',)
+)
+scheduler_job_lag = registry.histogram(
+    'bot_scheduler_job_lag_seconds', 'Delay between the scheduled and the actual job start', ('job',)
+)
+scheduler_job_errors = registry.counter(
+    'bot_scheduler_job_errors_total', 'Failed or missed scheduler jobs', ('job', 'event')
+)
+throttled_updates = registry.counter(
+    'bot_throttled_updates_total', 'Updates dropped by throttling or load shedding', ('handler', 'reason')
+)
+duplicate_updates = registry.counter(
+    'bot_duplicate_updates_total', 'Re-delivered updates dropped before processing'
+)
+coalesced_calls = registry.counter(
+    'bot_coalesced_calls_total', 'Calls served by an identical call already running', ('function',)
+)
+dropped_notifications = registry.counter(
+    'bot_dropped_notifications_total', 'Buffered notifications dropped after every write attempt failed'
+)
+slow_updates = registry.counter(
+    'bot_slow_updates_total', 'Traced updates slower than the slow update threshold'
+)
+
+
+def stats_gauge(name: str, documentation: str, get_stats):
+    """
+    Exposes a stats dict of some component as a gauge labelled by stat name.
+    :param get_stats: Function returning the current {stat: number} dict.
+    """
+    gauge = registry.gauge(name, documentation, ('stat',))
+
+    async def collect():
+        for stat, value in get_stats().items():
+            gauge.set(value, stat=stat)
+
+    registry.add_collector(collect)
+    return gauge
+
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=await registry.render(), content_type='text/plain', charset='utf-8')
+
+
+async def serve_metrics(host: str, port: int, path: str):
+    """
+    Starts a separate metrics endpoint, used by worker processes which have no web app of their own.
+    :return: Returns aiohttp AppRunner to clean up on shutdown.
+    """
+    app = web.Application()
+    app.router.add_get(path, metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
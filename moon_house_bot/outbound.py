@@ -0,0 +1,205 @@
+import asyncio
+import io
+import logging
+import time
+from collections import defaultdict, deque
+
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import NetworkError, RetryAfter
+
+from moon_house_bot.metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class _Outgoing:
+    __slots__ = ('method', 'kwargs', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, method: str, kwargs: dict, future: asyncio.Future):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class Upload:
+    """
+    File sent from memory. aiohttp closes the stream it uploaded, so every attempt gets a fresh InputFile.
+    """
+    __slots__ = ('data', 'filename')
+
+    def __init__(self, data: bytes, filename: str):
+        self.data = data
+        self.filename = filename
+
+    def input_file(self):
+        return InputFile(io.BytesIO(self.data), self.filename)
+
+
+class OutboundDispatcher:
+    """
+    Sends outgoing Bot API calls concurrently within Telegram flood limits.
+    Calls to the same chat are sent one by one in the order they were enqueued,
+    different chats are served by a pool of workers sharing the global rate.
+    :param bot: Bot instance to send with.
+    :param float global_rate: Calls per second for the whole bot, Telegram counts them across all its processes.
+    :param float private_chat_interval: Seconds between calls to the same private chat.
+    :param float group_chat_interval: Seconds between calls to the same group chat.
+    :param int workers: Amount of concurrent senders.
+    :param int max_retries: Attempts on RetryAfter or network errors before the call is given up.
+    :param int processes: Bot processes sending at once, each of them gets an equal share of the global rate.
+    """
+
+    def __init__(self, bot, global_rate: float = 30, private_chat_interval: float = 1,
+                 group_chat_interval: float = 3, workers: int = 8, max_retries: int = 5, processes: int = 1):
+        self.bot = bot
+        self.global_rate = global_rate / processes
+        self.private_chat_interval = private_chat_interval
+        self.group_chat_interval = group_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.send_latencies = deque(maxlen=1000)
+        self.queue_latencies = deque(maxlen=1000)
+
+        self._pending = defaultdict(deque)
+        self._scheduled = set()
+        self._next_allowed = {}
+        self._depth = 0
+        self._tokens = self.global_rate
+        self._tokens_updated = time.monotonic()
+        self._ready = None
+        self._tasks = []
+
+    @property
+    def queue_depth(self):
+        return self._depth
+
+    @property
+    def stats(self):
+        return {
+            'queue_depth': self._depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'send_latency_p50': percentile(self.send_latencies, 50),
+            'send_latency_p95': percentile(self.send_latencies, 95),
+            'queue_latency_p95': percentile(self.queue_latencies, 95),
+        }
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10):
+        # let already enqueued calls go out before the bot session is closed
+        deadline = time.monotonic() + timeout
+        while self._depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._depth:
+            logger.warning(f'Dropping {self._depth} outbound calls on shutdown')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id, method: str, **kwargs):
+        """
+        Enqueues a Bot API call, the chat_id is passed to the method as is.
+        :return: Returns future with the method result, there is no need to await it.
+        """
+        future = asyncio.get_event_loop().create_future()
+        # failures are logged by the dispatcher, nobody has to retrieve them from the future
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # ids come both as int and str (from callback data), both have to hit the same queue
+        key = str(chat_id)
+        self._pending[key].append(_Outgoing(method, dict(chat_id=chat_id, **kwargs), future))
+        self._depth += 1
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._schedule(key, self._next_allowed.get(key, 0) - time.monotonic())
+        return future
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        return self.submit(chat_id, 'send_message', text=text, **kwargs)
+
+    def send_document(self, chat_id, data: bytes, filename: str, **kwargs):
+        return self.submit(chat_id, 'send_document', document=Upload(data, filename), **kwargs)
+
+    def _schedule(self, chat_id, delay: float):
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def _chat_interval(self, chat_id):
+        # group and supergroup ids are negative
+        return self.group_chat_interval if chat_id.startswith('-') else self.private_chat_interval
+
+    async def _acquire_global(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.global_rate, self._tokens + (now - self._tokens_updated) * self.global_rate)
+            self._tokens_updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.global_rate)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._send_next(chat_id)
+            except Exception:
+                logger.exception(f'Outbound worker failed on chat {chat_id}')
+
+    async def _send_next(self, chat_id):
+        queue = self._pending[chat_id]
+        outgoing = queue.popleft()
+        await self._acquire_global()
+        started = time.monotonic()
+        delay = self._chat_interval(chat_id)
+        try:
+            outgoing.attempts += 1
+            kwargs = {k: v.input_file() if isinstance(v, Upload) else v for k, v in outgoing.kwargs.items()}
+            result = await getattr(self.bot, outgoing.method)(**kwargs)
+        except (RetryAfter, NetworkError, asyncio.TimeoutError) as e:
+            if outgoing.attempts >= self.max_retries:
+                self._finish(outgoing, exception=e)
+                logger.error(f'Giving up {outgoing.method} to {chat_id} after {outgoing.attempts} attempts: {e}')
+            else:
+                self.retried += 1
+                delay = e.timeout if isinstance(e, RetryAfter) else min(2 ** outgoing.attempts, 60)
+                logger.warning(f'Retrying {outgoing.method} to {chat_id} in {delay}s: {e}')
+                queue.appendleft(outgoing)
+        except Exception as e:
+            self._finish(outgoing, exception=e)
+            logger.error(f'Failed {outgoing.method} to {chat_id}: {e}')
+        else:
+            self.send_latencies.append(time.monotonic() - started)
+            self._finish(outgoing, result=result)
+
+        now = time.monotonic()
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {c: t for c, t in self._next_allowed.items() if t > now}
+        self._next_allowed[chat_id] = now + delay
+        if queue:
+            self._schedule(chat_id, delay)
+        else:
+            self._scheduled.discard(chat_id)
+            del self._pending[chat_id]
+
+    def _finish(self, outgoing: _Outgoing, result=None, exception: Exception = None):
+        self._depth -= 1
+        self.queue_latencies.append(time.monotonic() - outgoing.enqueued)
+        if exception is None:
+            self.sent += 1
+            outgoing.future.set_result(result)
+        else:
+            self.failed += 1
+            outgoing.future.set_exception(exception)
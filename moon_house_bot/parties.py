@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+from collections import defaultdict, namedtuple
+from datetime import date
+
+from sqlalchemy import and_
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import Party, User
+
+UpcomingParty = namedtuple(
+    'UpcomingParty',
+    ('id', 'user_id', 'household_id', 'party_date', 'guests_amount', 'using_sofa', 'firstname', 'lastname'),
+)
+
+
+def _upcoming_query():
+    return Party.join(User).select().where(and_(
+        Party.party_date >= date.today(),
+        Party.deleted.is_(None)
+    ))
+
+
+def _from_row(row):
+    return UpcomingParty(
+        row.id, row.user_id, row[Party.household_id], row.party_date, row.guests_amount, row.using_sofa,
+        row.firstname, row.lastname,
+    )
+
+
+class _HouseholdParties:
+    def __init__(self):
+        self.dates = []
+        self.by_date = {}
+        self.occupancy = {}
+
+
+class PartyIndex:
+    """
+    Active parties from today on with the names of their bookers, ordered by date in every household
+    and keyed by id and owner. There is at most one active party a date in a household.
+    Past dates are dropped on the first access to the household after midnight.
+    Booked days of a month are also kept as a bitmap for the calendar until a party of that month changes.
+    With several bot processes the id of every changed party is broadcast and the others reload it.
+    :param Broadcast broadcast: Channel to the other bot processes.
+    """
+    channel = 'parties'
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self._households = {}
+        self._by_id = {}
+        self._by_owner = defaultdict(dict)
+        self._tasks = set()
+        broadcast.listen(self.channel, self._on_change)
+
+    async def load(self):
+        rows = await _upcoming_query().gino.all()
+        self._households.clear()
+        self._by_id.clear()
+        self._by_owner.clear()
+        for row in rows:
+            self._store(_from_row(row))
+
+    def _household(self, household_id: int):
+        household = self._households.get(household_id)
+        if household is None:
+            household = self._households[household_id] = _HouseholdParties()
+        return household
+
+    def _store(self, party: UpcomingParty):
+        self._discard(party.id)
+        household = self._household(party.household_id)
+        self._by_id[party.id] = party
+        household.by_date[party.party_date] = party
+        self._by_owner[party.user_id][party.id] = party
+        bisect.insort(household.dates, party.party_date)
+        household.occupancy.pop((party.party_date.year, party.party_date.month), None)
+
+    def _discard(self, party_id: int):
+        party = self._by_id.pop(party_id, None)
+        if party is None:
+            return
+        household = self._households[party.household_id]
+        del household.by_date[party.party_date]
+        del household.dates[bisect.bisect_left(household.dates, party.party_date)]
+        household.occupancy.pop((party.party_date.year, party.party_date.month), None)
+        if not household.dates:
+            del self._households[party.household_id]
+        owned = self._by_owner[party.user_id]
+        del owned[party_id]
+        if not owned:
+            del self._by_owner[party.user_id]
+
+    def _current(self, household_id: int):
+        household = self._households.get(household_id)
+        if household is None:
+            return _HouseholdParties()
+        today = date.today()
+        while household.dates and household.dates[0] < today:
+            self._discard(household.by_date[household.dates[0]].id)
+        return household
+
+    def households(self):
+        """
+        :return: Returns list of ids of the households with upcoming parties.
+        """
+        return list(self._households)
+
+    def get(self, household_id: int, party_id: int):
+        party = self._by_id.get(party_id)
+        if party is None or party.household_id != household_id or party.party_date < date.today():
+            return None
+        return party
+
+    def on_date(self, household_id: int, party_date: date):
+        return self._current(household_id).by_date.get(party_date)
+
+    def upcoming(self, household_id: int, limit: int = None, until: date = None):
+        """
+        :param int limit: Amount of the closest parties to return.
+        :param date until: The last date to return parties for.
+        :return: Returns list of UpcomingParty of the household ordered by date.
+        """
+        household = self._current(household_id)
+        dates = household.dates[:bisect.bisect_right(household.dates, until)] if until else household.dates
+        return [household.by_date[d] for d in dates[:limit]]
+
+    def occupancy(self, household_id: int, year: int, month: int):
+        """
+        :return: Returns int bitmap of the month in the household, bit N is set if day N is booked.
+        """
+        household = self._current(household_id)
+        bitmap = household.occupancy.get((year, month))
+        if bitmap is None:
+            first_day = date(year, month, 1)
+            next_month = date(year + month // 12, month % 12 + 1, 1)
+            start = bisect.bisect_left(household.dates, first_day)
+            end = bisect.bisect_left(household.dates, next_month)
+            bitmap = 0
+            for day in household.dates[start:end]:
+                bitmap |= 1 << day.day
+            if household.dates:
+                household.occupancy[(year, month)] = bitmap
+        return bitmap
+
+    def owned_by(self, user_id: int):
+        today = date.today()
+        return sorted(
+            (p for p in self._by_owner.get(user_id, {}).values() if p.party_date >= today),
+            key=lambda p: p.party_date,
+        )
+
+    async def put(self, party: UpcomingParty):
+        """
+        Adds a booked party or replaces it after an edit.
+        """
+        self._store(party)
+        await self.broadcast.notify(self.channel, party.id)
+
+    async def remove(self, party_id: int):
+        self._discard(party_id)
+        await self.broadcast.notify(self.channel, party_id)
+
+    def _on_change(self, party_id: int):
+        task = asyncio.ensure_future(self._reload(party_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reload(self, party_id: int):
+        row = await _upcoming_query().where(Party.id == party_id).gino.first()
+        self._discard(party_id)
+        if row:
+            self._store(_from_row(row))
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from moon_house_bot.metrics import coalesced_calls, throttled_updates
+
+THROTTLED_ANSWERS = {
+    'user_rate': 'Не так быстро 🙂',
+    'handler_rate': 'Не так быстро 🙂',
+    'overload': 'Бот сейчас перегружен, попробуй чуть позже',
+}
+
+
+class TokenBuckets:
+    """
+    Token buckets keyed by user id, the least recently used are forgotten and start full again.
+    :param float rate: Tokens added per second.
+    :param int burst: Tokens a bucket holds at most.
+    :param int max_size: Amount of buckets kept.
+    """
+
+    def __init__(self, rate: float, burst: int, max_size: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def take(self, key):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        taken = tokens >= 1
+        self._buckets[key] = (tokens - 1 if taken else tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return taken
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Drops updates of users tapping faster than rate a second, and taps of expensive handlers over their own limits.
+    While the bot is overloaded expensive handlers are not run at all.
+    Dropped callback queries are answered right away, so the button stops spinning.
+    :param float rate: Updates a second every user gets.
+    :param int burst: Updates a user can send at once.
+    :param dict handlers: Limits of expensive handlers, {handler name: {'rate': float, 'burst': int}}.
+    :param overloaded: Function returning True when the bot has to shed load.
+    :param int max_users: Amount of users whose buckets are kept.
+    """
+
+    def __init__(self, rate: float = 2, burst: int = 10, handlers: dict = None, overloaded=None,
+                 max_users: int = 10000):
+        super().__init__()
+        self.users = TokenBuckets(rate, burst, max_users)
+        self.handlers = {
+            name: TokenBuckets(limits['rate'], limits['burst'], max_users) for name, limits in (handlers or {}).items()
+        }
+        self.overloaded = overloaded
+
+    async def _throttle(self, user_id: int, call: types.CallbackQuery = None):
+        name = current_handler.get().__name__
+        reason = None
+        if not self.users.take(user_id):
+            reason = 'user_rate'
+        elif name in self.handlers:
+            if self.overloaded and self.overloaded():
+                reason = 'overload'
+            elif not self.handlers[name].take(user_id):
+                reason = 'handler_rate'
+        if reason:
+            throttled_updates.inc(handler=name, reason=reason)
+            if call:
+                await call.answer(THROTTLED_ANSWERS[reason])
+            raise CancelHandler()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self._throttle(message.from_user.id)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        await self._throttle(call.from_user.id, call)
+
+
+def coalesce(func):
+    """
+    Concurrent calls of the coroutine function with the same arguments share a single run.
+    """
+    running = {}
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        future = running.get(key)
+        if future is None:
+            future = running[key] = asyncio.ensure_future(func(*args, **kwargs))
+            future.add_done_callback(lambda _: running.pop(key, None))
+        else:
+            coalesced_calls.inc(function=func.__name__)
+        # one of the callers being cancelled must not cancel the others
+        return await asyncio.shield(future)
+
+    return wrapper
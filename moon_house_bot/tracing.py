@@ -0,0 +1,155 @@
+import logging
+import time
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+from moon_house_bot.metrics import slow_updates
+
+logger = logging.getLogger(__name__)
+
+# the innermost open span of the update processed by the current task, None if it is not traced
+_current_span = ContextVar('current_span', default=None)
+_NOT_TRACED = nullcontext()
+
+
+class Span:
+    """
+    Timed part of an update processing. Merged spans stand for many short calls of the same kind,
+    e.g. filter checks, and keep their count and total duration only.
+    """
+    __slots__ = ('name', 'attrs', 'started', 'duration', 'count', 'merged', 'children')
+
+    def __init__(self, name: str, attrs: dict = None, merged: bool = False):
+        self.name = name
+        self.attrs = attrs or {}
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.count = 1
+        self.merged = merged
+        self.children = []
+
+    def add_merged(self, name: str, duration: float):
+        for child in self.children:
+            if child.merged and child.name == name:
+                child.count += 1
+                child.duration += duration
+                return
+        child = Span(name, merged=True)
+        child.started -= duration
+        child.duration = duration
+        self.children.append(child)
+
+    def to_dict(self, origin: float = None):
+        origin = self.started if origin is None else origin
+        span = {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+        }
+        if self.merged:
+            span['count'] = self.count
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.children:
+            span['children'] = [child.to_dict(origin) for child in self.children]
+        return span
+
+    def render(self, depth: int = 0):
+        count = f' x{self.count}' if self.merged else ''
+        attrs = ' '.join(f'{k}={v}' for k, v in self.attrs.items())
+        lines = [f'{self.duration * 1000:9.2f} ms  {"  " * depth}{self.name}{count} {attrs}'.rstrip()]
+        for child in self.children:
+            lines.extend(child.render(depth + 1))
+        return lines
+
+
+class _SpanContext:
+    __slots__ = ('span', '_parent', '_token')
+
+    def __init__(self, parent: Span, name: str, attrs: dict):
+        self._parent = parent
+        self.span = Span(name, attrs)
+
+    def __enter__(self):
+        self._parent.children.append(self.span)
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.duration = time.perf_counter() - self.span.started
+        _current_span.reset(self._token)
+
+
+def span(name: str, **attrs):
+    """
+    Context manager timing a part of the traced update as a child of the innermost open span.
+    Outside of a traced update it does nothing.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return _NOT_TRACED
+    return _SpanContext(parent, name, attrs)
+
+
+class _MergedSpanContext:
+    __slots__ = ('_parent', '_name', '_started')
+
+    def __init__(self, parent: Span, name: str):
+        self._parent = parent
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._parent.add_merged(self._name, time.perf_counter() - self._started)
+
+
+def merged_span(name: str):
+    """
+    Like span(), but all the spans of the name within the parent are counted and timed as one.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return _NOT_TRACED
+    return _MergedSpanContext(parent, name)
+
+
+class UpdateTracer:
+    """
+    Traces every update while enabled and keeps the span trees of the ones slower than slow_update.
+    They are logged and the last of them are kept in memory.
+    :param bool enabled: If False, the dispatcher is not wrapped at all and span() calls return right away.
+    :param float slow_update: Seconds an update has to take to be kept.
+    :param int keep: Amount of the last slow updates kept in memory.
+    """
+
+    def __init__(self, enabled: bool = False, slow_update: float = 0.5, keep: int = 100):
+        self.enabled = enabled
+        self.slow_update = slow_update
+        self.slow = deque(maxlen=keep)
+
+    def trace(self, process_update):
+        """
+        Wraps the update processing of the dispatcher, filter matching and handlers run within it.
+        """
+        @wraps(process_update)
+        async def wrapper(update, *args, **kwargs):
+            root = Span('update', {'update_id': update.update_id})
+            token = _current_span.set(root)
+            try:
+                return await process_update(update, *args, **kwargs)
+            finally:
+                root.duration = time.perf_counter() - root.started
+                _current_span.reset(token)
+                if root.duration >= self.slow_update:
+                    self._keep(root)
+
+        return wrapper
+
+    def _keep(self, root: Span):
+        slow_updates.inc()
+        self.slow.append(root.to_dict())
+        logger.warning(f'Slow update {root.attrs["update_id"]}:\n' + '\n'.join(root.render()))
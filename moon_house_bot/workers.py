@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from queue import Empty
+
+from aiohttp import web
+
+from moon_house_bot.dedup import RecentUpdates
+from moon_house_bot.metrics import metrics_handler
+
+logger = logging.getLogger(__name__)
+
+
+def update_routing_key(data: dict):
+    """
+    Picks the id the update is ordered by: the user who sent it, or the chat if there is no user.
+    :param dict data: Raw update as it came to the webhook.
+    :return: Returns int key, 0 for updates without any.
+    """
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return int(user['id'])
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if chat:
+            return int(chat['id'])
+    return 0
+
+
+class OrderedProcessor:
+    """
+    Runs coroutines concurrently, but one by one for the same key and in the order they were submitted.
+    :param process: Coroutine function getting the submitted arguments.
+    :param int concurrency: Amount of coroutines running at once.
+    """
+
+    def __init__(self, process, concurrency: int = 64):
+        self.process = process
+        self.concurrency = concurrency
+        self.pending = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tails = {}
+
+    def submit(self, key, *args):
+        previous = self._tails.get(key)
+        task = asyncio.ensure_future(self._run(previous, args))
+        self._tails[key] = task
+        self.pending += 1
+        task.add_done_callback(partial(self._forget, key))
+        return task
+
+    async def _run(self, previous, args):
+        if previous:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                return await self.process(*args)
+            except Exception:
+                logger.exception('Failed to process update')
+
+    def _forget(self, key, task):
+        self.pending -= 1
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def wait_capacity(self, limit: int):
+        while self.pending >= limit and self._tails:
+            await asyncio.wait(set(self._tails.values()), return_when=asyncio.FIRST_COMPLETED)
+
+    async def join(self):
+        while self._tails:
+            await asyncio.wait(set(self._tails.values()))
+
+
+def _get_batch(queue, size: int):
+    # one blocking get and whatever else is already there, a thread hop per update is too slow
+    batch = [queue.get()]
+    try:
+        while len(batch) < size and batch[-1] is not None:
+            batch.append(queue.get_nowait())
+    except Empty:
+        pass
+    return batch
+
+
+async def _serve(index: int, queue, ready, concurrency: int, target: str):
+    module_name, _, name = target.partition(':')
+    module = __import__(module_name, fromlist=[name])
+    startup, process, shutdown = getattr(module, name)(index)
+
+    loop = asyncio.get_event_loop()
+    await startup()
+    processor = OrderedProcessor(process, concurrency)
+    ready.set()
+    logger.info(f'Worker {index} started')
+    try:
+        stopped = False
+        while not stopped:
+            await processor.wait_capacity(concurrency * 4)
+            for data in await loop.run_in_executor(None, _get_batch, queue, concurrency):
+                if data is None:
+                    stopped = True
+                    break
+                processor.submit(update_routing_key(data), data)
+        await processor.join()
+    finally:
+        await shutdown()
+        logger.info(f'Worker {index} stopped')
+
+
+def _run_worker(index: int, queue, ready, concurrency: int, target: str):
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_serve(index, queue, ready, concurrency, target))
+    loop.close()
+
+
+class WorkerPool:
+    """
+    Spreads webhook updates over worker processes by routing key, so every conversation
+    is always handled by the same worker and in order.
+    :param int workers: Amount of worker processes.
+    :param int concurrency: Updates processed at once by a single worker.
+    :param str target: 'module:function' getting the worker index and returning (startup, process, shutdown)
+        coroutine functions of a worker, the process one gets the raw update dict.
+    :param int dedup_size: Amount of the last update ids remembered to drop re-delivered updates.
+    """
+
+    def __init__(self, workers: int, concurrency: int = 64, target: str = 'moon_house_bot.app:worker_hooks',
+                 dedup_size: int = 10000):
+        self.recent = RecentUpdates(dedup_size)
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.ready = [context.Event() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=_run_worker, args=(i, q, r, concurrency, target), daemon=True)
+            for i, (q, r) in enumerate(zip(self.queues, self.ready))
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def wait_ready(self, timeout: float = None):
+        return all(event.wait(timeout) for event in self.ready)
+
+    def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def dispatch(self, data: dict):
+        # all the updates pass this process, so it is the one place duplicates are seen across workers
+        if self.recent.seen(data['update_id']):
+            return
+        self.queues[update_routing_key(data) % len(self.queues)].put_nowait(data)
+
+    async def handle_webhook(self, request: web.Request):
+        self.dispatch(await request.json())
+        return web.Response()
+
+
+def run_workers(workers: int, concurrency: int, path: str, host: str, port: int, on_startup=None, on_shutdown=None,
+                dedup_size: int = 10000, metrics_path: str = None):
+    """
+    Serves the webhook from this process and handles the updates in worker processes.
+    :param on_startup: Coroutine function for the front process getting the WorkerPool, e.g. setting the webhook.
+    :param on_shutdown: Coroutine function for the front process getting the WorkerPool, e.g. removing the webhook.
+    :param str metrics_path: Where to serve the metrics of the front process, workers serve their own.
+    """
+    pool = WorkerPool(workers, concurrency, dedup_size=dedup_size)
+    app = web.Application()
+    app.router.add_post(path, pool.handle_webhook)
+    if metrics_path:
+        app.router.add_get(metrics_path, metrics_handler)
+
+    async def start_pool(_):
+        pool.start()
+        if on_startup:
+            await on_startup(pool)
+
+    async def stop_pool(_):
+        if on_shutdown:
+            await on_shutdown(pool)
+        await asyncio.get_event_loop().run_in_executor(None, pool.stop)
+
+    app.on_startup.append(start_pool)
+    app.on_shutdown.append(stop_pool)
+    web.run_app(app, host=host, port=port)
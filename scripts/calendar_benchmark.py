@@ -0,0 +1,36 @@
+"""
+Compares building calendar keyboards from scratch with the memoized create_calendar
+while paging through a year back and forth.
+
+Usage: python -m scripts.calendar_benchmark
+"""
+import timeit
+from datetime import date
+
+from aiogramcalendar import _build_calendar, _month_layout, create_calendar
+
+ROUNDS = 200
+
+
+def months_ahead(amount=12):
+    today = date.today()
+    return [((today.month + i - 1) // 12 + today.year, (today.month + i - 1) % 12 + 1) for i in range(amount)]
+
+
+def page_uncached():
+    today = date.today()
+    for year, month in months_ahead():
+        _build_calendar(_month_layout.__wrapped__(year, month, today))
+
+
+def page_cached():
+    for year, month in months_ahead():
+        create_calendar(year, month)
+
+
+if __name__ == '__main__':
+    pages = len(months_ahead())
+    for name, func in (('uncached', page_uncached), ('cached', page_cached)):
+        seconds = min(timeit.repeat(func, number=ROUNDS, repeat=5))
+        print(f'{name:>8}: {seconds / ROUNDS / pages * 1e6:8.1f} us per keyboard')
+    print(f'cache: {_month_layout.cache_info()}')
@@ -0,0 +1,160 @@
+"""
+Prints query plans of the hot read queries of the bot against the fully migrated schema,
+without the indexes of the hot tables and with them, as the migrations create them.
+The indexes are dropped and recreated inside a transaction that is rolled back in the end,
+so the database is left as it was, but the tables stay locked meanwhile: point it at a copy
+with a production-like amount of rows, on an almost empty database the planner prefers seq scans anyway.
+
+Usage: python -m scripts.explain_queries
+"""
+import asyncio
+import re
+from datetime import date, datetime, time, timedelta, timezone
+
+from sqlalchemy import and_, case, text
+
+from moon_house_bot.database import (
+    ActivityRollup,
+    Notification,
+    User,
+    db,
+    get_database_url,
+    migrate,
+)
+from moon_house_bot.database.migrations import MIGRATIONS
+from moon_house_bot.export import notifications_query
+from moon_house_bot.parties import _upcoming_query
+from scripts.seed_history import SEED_HOUSEHOLD_ID, SEED_USER_BASE
+
+HOT_TABLES = ('notifications', 'parties', 'users', 'activity_rollup')
+CREATE_INDEX = re.compile(r'CREATE (?:UNIQUE )?INDEX (?:IF NOT EXISTS )?(\w+) ON (\w+)')
+DROP_INDEX = re.compile(r'DROP INDEX (?:IF EXISTS )?(\w+)')
+
+
+def index_definitions():
+    """
+    :return: Returns dict of the CREATE INDEX steps of the indexes of the hot tables the latest migration leaves,
+        keyed by index name.
+    """
+    definitions = {}
+    for migration in MIGRATIONS:
+        for step in filter(lambda s: isinstance(s, str), migration.steps):
+            created, dropped = CREATE_INDEX.match(step), DROP_INDEX.match(step)
+            if created and created.group(2) in HOT_TABLES:
+                definitions[created.group(1)] = step
+            elif dropped:
+                definitions.pop(dropped.group(1), None)
+    return definitions
+
+
+def hot_queries():
+    # the same clauses the bot runs, for the seeded household
+    day_start = datetime.combine(date.today(), time()).astimezone()
+    # the partition of the current month, appliance states are looked up there first
+    month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    appliance_types = ['dishwasher_load', 'dishwasher_unload']
+    last_actions = db.select([
+        Notification.household_id, Notification.notification_type, Notification.user_id, Notification.created,
+    ]).distinct(
+        Notification.household_id, Notification.notification_type
+    ).order_by(
+        Notification.household_id, Notification.notification_type, Notification.created.desc()
+    )
+    return {
+        'activity counters of the day': db.select([
+            Notification.household_id, Notification.notification_type, db.func.count()
+        ]).where(and_(
+            Notification.created >= day_start,
+            Notification.deleted.is_(None)
+        )).group_by(Notification.household_id, Notification.notification_type),
+        'recent silence notifications': db.select([Notification.household_id, Notification.created]).where(and_(
+            Notification.notification_type == 'silence',
+            Notification.created > datetime.now().astimezone() - timedelta(minutes=30),
+            Notification.deleted.is_(None)
+        )).order_by(Notification.created),
+        'appliance states of the month': last_actions.where(and_(
+            Notification.notification_type.in_(appliance_types),
+            Notification.deleted.is_(None),
+            Notification.created >= month_start,
+        )),
+        'appliance states of idle households': last_actions.where(and_(
+            Notification.notification_type.in_(appliance_types),
+            Notification.deleted.is_(None),
+            Notification.created < month_start,
+            Notification.household_id.in_([SEED_HOUSEHOLD_ID]),
+        )),
+        'upcoming parties': _upcoming_query(),
+        'rating': db.select([
+            User.chat_id,
+            User.firstname,
+            User.lastname,
+            db.func.sum(ActivityRollup.amount).label('total'),
+            db.func.sum(case(
+                [((ActivityRollup.notification_type.startswith('dishwasher')), ActivityRollup.amount)], else_=0
+            )).label('dishwasher'),
+            db.func.sum(case(
+                [((ActivityRollup.notification_type == 'trash'), ActivityRollup.amount)], else_=0
+            )).label('trash'),
+        ]).select_from(User.join(ActivityRollup)).where(and_(
+            ActivityRollup.household_id == SEED_HOUSEHOLD_ID,
+            ActivityRollup.notification_type != 'silence'
+        )).group_by(User.chat_id).having(db.func.sum(ActivityRollup.amount) > 0).order_by(text('total DESC')),
+        'silence statistics': db.select([
+            db.func.coalesce(db.func.sum(case(
+                [((ActivityRollup.user_id == SEED_USER_BASE), ActivityRollup.amount)], else_=0
+            )), 0).label('yours'),
+            db.func.coalesce(db.func.sum(case(
+                [((ActivityRollup.user_id != SEED_USER_BASE), ActivityRollup.amount)], else_=0
+            )), 0).label('others'),
+        ]).select_from(User.join(ActivityRollup)).where(and_(
+            ActivityRollup.household_id == SEED_HOUSEHOLD_ID,
+            ActivityRollup.notification_type == 'silence'
+        )),
+        'household users': User.query.where(User.household_id == SEED_HOUSEHOLD_ID),
+        'history export': notifications_query(SEED_HOUSEHOLD_ID),
+    }
+
+
+async def explain(connection, clause):
+    compiled = clause.compile(dialect=db.bind.dialect)
+    params = compiled.construct_params()
+    rows = await connection.fetch(
+        f'EXPLAIN {compiled}', *[params[name] for name in compiled.positiontup or ()]
+    )
+    return '\n'.join(row[0] for row in rows)
+
+
+async def print_plans(connection, title):
+    print(f'===== {title} =====')
+    for name, clause in hot_queries().items():
+        print(f'--- {name}')
+        print(await explain(connection, clause))
+    print()
+
+
+async def analyze():
+    for table in HOT_TABLES:
+        await db.status(text(f'ANALYZE {table}'))
+
+
+async def main():
+    await db.set_bind(get_database_url())
+    await migrate()
+    definitions = index_definitions()
+    async with db.transaction() as tx:
+        connection = tx.connection.raw_connection
+        for index in definitions:
+            await db.status(text(f'DROP INDEX IF EXISTS {index}'))
+        await analyze()
+        await print_plans(connection, 'without indexes')
+
+        for definition in definitions.values():
+            await db.status(text(definition))
+        await analyze()
+        await print_plans(connection, 'with indexes')
+        tx.raise_rollback()
+    await db.pop_bind().close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
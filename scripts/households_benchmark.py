@@ -0,0 +1,96 @@
+"""
+Replays the same synthetic sessions with the same users spread over 1 to 10,000 households
+and reports handler latency percentiles for every amount of households. They should stay flat:
+all in-memory state is keyed by household and the queries are served by indexes led by it.
+Only the rating gets cheaper with more households, as every one of them has fewer tenants.
+
+Needs a scratch database and runs against the fake Bot API, the same way as replay_benchmark.
+
+Usage: python -m scripts.households_benchmark [--users N] [--sessions N] [--rounds N] [--concurrency N]
+                                              [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+
+from config import settings
+from moon_house_bot.app import bot, close_app, dp, init_app, members
+from moon_house_bot.metrics import percentile
+from scripts.replay_benchmark import (
+    FakeTelegramApi,
+    record_handler_latency,
+    replay,
+    reset_bench_data,
+    seed_users,
+    synthetic_updates,
+)
+
+HOUSEHOLDS = (1, 10, 100, 1000, 10000)
+
+
+async def run(args):
+    api = FakeTelegramApi()
+    bot.server = await api.start()
+    await init_app(dp)
+    # every synthetic user fits into the members cache, so the comparison isn't about its size
+    members.max_size = max(members.max_size, args.users)
+    updates = synthetic_updates(args.users, args.sessions)
+    samples = defaultdict(list)
+    record_handler_latency(samples)
+    report = []
+    # update ids keep growing over all runs, repeated ones are dropped as re-deliveries
+    round_number = 0
+    try:
+        for households in HOUSEHOLDS:
+            await seed_users(args.users, households)
+            latencies, throughputs = [], []
+            for measured in range(args.rounds + 1):
+                await reset_bench_data(args.users)
+                samples.clear()
+                elapsed = await replay(updates, args.concurrency, round_number)
+                round_number += 1
+                # the first round after moving the users is a warm-up
+                if measured:
+                    throughputs.append(len(updates) / elapsed)
+                    latencies.extend(latency for handler in samples.values() for latency in handler)
+            report.append({
+                'households': households,
+                'updates_per_sec': round(percentile(throughputs, 50)),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            })
+            print_row(report[-1])
+    finally:
+        await close_app(dp)
+        await bot.close()
+        await api.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def print_row(row):
+    if row['households'] == HOUSEHOLDS[0]:
+        print(f"{'households':>10} {'updates/sec':>12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    print(f"{row['households']:10} {row['updates_per_sec']:12} "
+          f"{row['p50_ms']:8.2f} {row['p95_ms']:8.2f} {row['p99_ms']:8.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measures handler latency from 1 to 10,000 households')
+    parser.add_argument('--users', type=int, default=max(HOUSEHOLDS), help='synthetic users, 10,000 at least')
+    parser.add_argument('--sessions', type=int, default=2000, help='synthetic sessions per round')
+    parser.add_argument('--rounds', type=int, default=3, help='measured rounds for every amount of households')
+    parser.add_argument('--concurrency', type=int, default=settings.workers.concurrency)
+    parser.add_argument('--output', help='JSON file to write the report to')
+    args = parser.parse_args()
+    if args.users < max(HOUSEHOLDS):
+        parser.error(f'at least {max(HOUSEHOLDS)} users')
+    return args
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,358 @@
+"""
+Replays webhook updates against the bot dispatcher and reports throughput, latency percentiles
+per handler and DB queries per update.
+
+Bot API calls go to a local fake server answering every method right away (or after --api-latency),
+the database is the one from settings.toml, so point it at a scratch one: synthetic users are created
+there, spread over --households households, and their notifications, parties and FSM states
+are wiped before every round.
+Synthetic sessions (menu taps, dishwasher loads and unloads, full party bookings, statistics) are
+generated with a fixed seed and the first round is a warm-up, so runs are comparable across commits.
+Recorded updates (--updates, one raw webhook update per line) are replayed as is, so their users
+have to exist in the database and nothing is wiped between rounds.
+
+Usage: python -m scripts.replay_benchmark [--users N] [--households N] [--sessions N] [--rounds N]
+                                          [--concurrency N] [--api-latency MS] [--updates FILE] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+from sqlalchemy.dialects.postgresql import insert
+
+from config import settings
+from moon_house_bot.app import bot, close_app, dp, init_app, load_state, process_raw_update
+from moon_house_bot.database import ActivityRollup, FsmState, Household, Notification, Party, User
+from moon_house_bot.metrics import db_queries, percentile, throttled_updates
+from moon_house_bot.workers import OrderedProcessor, update_routing_key
+
+# top of the int4 range users.chat_id holds, far above the ids of the household
+BENCH_USER_BASE = 2_140_000_000
+# group chat ids are negative, the households go down from there
+BENCH_HOUSEHOLD_BASE = -BENCH_USER_BASE
+BENCH_BOT = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+SEED = 4617
+
+
+class FakeTelegramApi:
+    """
+    Local stand-in for the Bot API, answers with minimal valid results and counts calls per method.
+    :param float latency: Seconds every call takes.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+        self._runner = None
+
+    def _message(self, data):
+        self._message_id += 1
+        chat_id = int(data.get('chat_id', 0))
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': BENCH_BOT,
+            'text': data.get('text', ''),
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method'].lower()
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ('sendmessage', 'editmessagetext', 'editmessagereplymarkup'):
+            result = self._message(data)
+        elif method == 'getme':
+            result = BENCH_BOT
+        elif method == 'getwebhookinfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return TelegramAPIServer.from_base(f'http://{host}:{port}')
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+def _user(user_id: int):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'last_name': str(user_id - BENCH_USER_BASE)}
+
+
+def _text(user_id: int, text: str):
+    user = _user(user_id)
+    return {'message': {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': dict(user, type='private'),
+        'from': user,
+        'text': text,
+    }}
+
+
+def _callback(user_id: int, data: str):
+    user = _user(user_id)
+    return {'callback_query': {
+        'id': str(user_id),
+        'from': user,
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': dict(user, type='private'),
+            'from': BENCH_BOT,
+            'text': 'Bench',
+        },
+    }}
+
+
+def _party_session(user_id: int, party_date: date):
+    return [
+        _text(user_id, 'Тусовки 🍻'),
+        _callback(user_id, 'party_new'),
+        _callback(user_id, f'calendar:DAY:{party_date.year}:{party_date.month}:{party_date.day}'),
+        _text(user_id, '5'),
+        _callback(user_id, 'sofa_using_yes'),
+        _callback(user_id, 'party_manage'),
+    ]
+
+
+SESSIONS = {
+    'menu': lambda user_id, _: [_text(user_id, '/home')],
+    'trash': lambda user_id, _: [_text(user_id, 'Выкинуть мусор 🗑')],
+    'dishwasher': lambda user_id, _: [
+        _text(user_id, 'Посудомойка 🍴'),
+        _callback(user_id, 'dishwasher_load'),
+        _text(user_id, 'Посудомойка 🍴'),
+        _callback(user_id, 'dishwasher_unload'),
+    ],
+    'party': _party_session,
+    'closest parties': lambda user_id, _: [_text(user_id, 'Тусовки 🍻'), _callback(user_id, 'party_closest')],
+    'silence': lambda user_id, _: [_text(user_id, 'Тише 🤫')],
+    'statistics': lambda user_id, _: [
+        _text(user_id, 'Статистика 📊'),
+        _callback(user_id, 'statistics_usefulness'),
+        _text(user_id, 'Статистика 📊'),
+        _callback(user_id, 'statistics_silence'),
+    ],
+}
+# roughly how the household uses the bot
+SESSION_WEIGHTS = {
+    'menu': 20, 'trash': 20, 'dishwasher': 20, 'party': 10, 'closest parties': 10, 'silence': 5, 'statistics': 15,
+}
+
+
+def synthetic_updates(users: int, sessions: int):
+    """
+    Generates sessions of random users and interleaves them, keeping the order of every session.
+    :return: Returns list of raw updates, the same for the same arguments.
+    """
+    rng = random.Random(SEED)
+    queues = defaultdict(list)
+    next_party_date = date.today() + timedelta(days=1)
+    for _ in range(sessions):
+        user_id = BENCH_USER_BASE + rng.randrange(users)
+        kind = rng.choices(list(SESSION_WEIGHTS), weights=list(SESSION_WEIGHTS.values()))[0]
+        queues[user_id].extend(SESSIONS[kind](user_id, next_party_date))
+        if kind == 'party':
+            next_party_date += timedelta(days=1)
+
+    updates = []
+    pending = [user_id for user_id, queue in queues.items() for _ in queue]
+    rng.shuffle(pending)
+    positions = Counter()
+    for update_id, user_id in enumerate(pending, 1):
+        update = dict(queues[user_id][positions[user_id]], update_id=update_id)
+        positions[user_id] += 1
+        updates.append(update)
+    return updates
+
+
+def _chunks(rows, size: int = 1000):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+async def seed_users(users: int, households: int = 1):
+    """
+    Creates the synthetic users and households, users are dealt to the households round-robin,
+    so running it again with another amount of households moves them.
+    """
+    now = datetime.now(timezone.utc)
+    for chunk in _chunks([BENCH_HOUSEHOLD_BASE - i for i in range(households)]):
+        await insert(Household).values([
+            {'chat_id': chat_id, 'title': 'Bench', 'created': now} for chat_id in chunk
+        ]).on_conflict_do_nothing().gino.status()
+    for chunk in _chunks(range(users)):
+        statement = insert(User).values([{
+            'chat_id': BENCH_USER_BASE + i,
+            'household_id': BENCH_HOUSEHOLD_BASE - i % households,
+            'firstname': 'Bench',
+            'lastname': str(i),
+            'created': now,
+        } for i in chunk])
+        await statement.on_conflict_do_update(
+            index_elements=[User.chat_id],
+            set_={'household_id': statement.excluded.household_id, 'deleted': None},
+        ).gino.status()
+
+
+async def reset_bench_data(users: int):
+    last = BENCH_USER_BASE + users
+    await Notification.delete.where(Notification.user_id.between(BENCH_USER_BASE, last)).gino.status()
+    await ActivityRollup.delete.where(ActivityRollup.user_id.between(BENCH_USER_BASE, last)).gino.status()
+    await Party.delete.where(Party.user_id.between(BENCH_USER_BASE, last)).gino.status()
+    await FsmState.delete.where(FsmState.user.in_([str(i) for i in range(BENCH_USER_BASE, last)])).gino.status()
+    dp.storage._cache.clear()
+    # the in-memory parties, counters and appliances would still have the wiped rows
+    await load_state()
+
+
+def record_handler_latency(samples):
+    """
+    Wraps the already instrumented handlers once more to keep raw latencies instead of histogram buckets.
+    """
+    def timed(handler):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                samples[handler.__name__].append(time.perf_counter() - started)
+
+        wrapper.__wrapped__ = handler
+        wrapper.__name__ = handler.__name__
+        return wrapper
+
+    for handler in (dp.message_handlers, dp.callback_query_handlers):
+        for handler_obj in handler.handlers:
+            handler_obj.handler = timed(handler_obj.handler)
+
+
+def total_db_queries():
+    return sum(db_queries._values.values())
+
+
+def total_throttled():
+    return sum(throttled_updates._values.values())
+
+
+async def replay(updates, concurrency: int, round_number: int):
+    processor = OrderedProcessor(process_raw_update, concurrency)
+    # every round gets fresh update ids, repeated ones are dropped as re-deliveries
+    offset = round_number * (max(u['update_id'] for u in updates) + 1)
+    updates = [dict(update, update_id=update['update_id'] + offset) for update in updates]
+    started = time.perf_counter()
+    for update in updates:
+        await processor.wait_capacity(concurrency * 4)
+        processor.submit(update_routing_key(update), update)
+    await processor.join()
+    return time.perf_counter() - started
+
+
+async def run(args):
+    api = FakeTelegramApi(args.api_latency / 1000)
+    bot.server = await api.start()
+    await init_app(dp)
+    try:
+        if args.updates:
+            with open(args.updates) as f:
+                updates = [json.loads(line) for line in f if line.strip()]
+        else:
+            await seed_users(args.users, args.households)
+            updates = synthetic_updates(args.users, args.sessions)
+
+        samples = defaultdict(list)
+        record_handler_latency(samples)
+        throughputs, queries, api_calls, throttled = [], 0, 0, 0
+        for round_number in range(args.rounds + 1):
+            if not args.updates:
+                await reset_bench_data(args.users)
+            queries_before, calls_before = total_db_queries(), sum(api.calls.values())
+            throttled_before = total_throttled()
+            elapsed = await replay(updates, args.concurrency, round_number)
+            if not round_number:
+                # the warm-up round fills the caches and the statement cache of every pooled connection
+                samples.clear()
+                continue
+            throughputs.append(len(updates) / elapsed)
+            queries += total_db_queries() - queries_before
+            throttled += total_throttled() - throttled_before
+            api_calls += sum(api.calls.values()) - calls_before
+            print(f'round {round_number}: {throughputs[-1]:8.0f} updates/sec')
+    finally:
+        await close_app(dp)
+        await bot.close()
+        await api.close()
+
+    measured = len(updates) * args.rounds
+    report = {
+        'updates': len(updates),
+        'rounds': args.rounds,
+        'concurrency': args.concurrency,
+        'updates_per_sec': round(percentile(throughputs, 50)),
+        'db_queries_per_update': round(queries / measured, 2),
+        'throttled_share': round(throttled / measured, 4),
+        'api_calls_per_update': round(api_calls / measured, 2),
+        'handlers': {
+            name: {
+                'calls': len(s) // args.rounds,
+                'p50_ms': round(percentile(s, 50) * 1000, 2),
+                'p95_ms': round(percentile(s, 95) * 1000, 2),
+                'p99_ms': round(percentile(s, 99) * 1000, 2),
+            }
+            for name, s in sorted(samples.items())
+        },
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def print_report(report):
+    print(f"\n{report['updates']} updates x {report['rounds']} rounds, concurrency {report['concurrency']}")
+    print(f"median throughput:  {report['updates_per_sec']} updates/sec")
+    print(f"DB queries/update:  {report['db_queries_per_update']}")
+    print(f"throttled share:    {report['throttled_share']}")
+    print(f"API calls/update:   {report['api_calls_per_update']}\n")
+    print(f"{'handler':32} {'calls':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, h in report['handlers'].items():
+        print(f"{name:32} {h['calls']:7} {h['p50_ms']:8.2f} {h['p95_ms']:8.2f} {h['p99_ms']:8.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replays webhook updates against the bot dispatcher')
+    # few sessions per user, so the per-user throttling rarely kicks in
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users')
+    parser.add_argument('--households', type=int, default=1, help='households the synthetic users live in')
+    parser.add_argument('--sessions', type=int, default=2000, help='synthetic sessions per round')
+    parser.add_argument('--rounds', type=int, default=3, help='measured rounds after the warm-up one')
+    parser.add_argument('--concurrency', type=int, default=settings.workers.concurrency)
+    parser.add_argument('--api-latency', type=float, default=0, help='ms every Bot API call takes')
+    parser.add_argument('--updates', help='JSONL file with recorded updates instead of synthetic ones')
+    parser.add_argument('--output', help='JSON file to write the report to, e.g. to diff between commits')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,185 @@
+"""
+Bulk-loads a production-like history into the configured database to profile the statistics paths:
+users, millions of notifications spread over the years and a party on part of the days, past and upcoming.
+Rows go in with COPY in batches, the old and deleted notifications are moved to the archive by the retention job,
+the activity rollup is rebuilt from them and the tables are analyzed,
+so explain_queries and replay_benchmark see the plans they would see in production.
+
+Seeded users have ids from SEED_USER_BASE on and live in their own household,
+rows of a previous seeding are deleted first,
+everything else in the database is left as is, apart from the retention job archiving its old notifications too.
+The same arguments always give the same data.
+
+Usage: python -m scripts.seed_history [--users N] [--notifications N] [--years N] [--party-share PERCENT]
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+from itertools import accumulate
+
+from sqlalchemy import text
+
+from config import settings
+from moon_house_bot.database import (
+    ActivityRollup,
+    Household,
+    Notification,
+    Party,
+    User,
+    archive_notifications,
+    backfill_activity,
+    create_live_partitions,
+    db,
+    get_database_url,
+    migrate,
+)
+
+# far above the ids of the household and below the replay benchmark users
+SEED_USER_BASE = 2_100_000_000
+SEED_USER_LIMIT = 2_140_000_000
+# group chat ids are negative
+SEED_HOUSEHOLD_ID = -SEED_USER_BASE
+SEED = 4617
+BATCH_SIZE = 100_000
+DELETED_SHARE = 0.02
+# roughly how often every kind of notification happens
+NOTIFICATION_WEIGHTS = {'trash': 35, 'dishwasher_load': 25, 'dishwasher_unload': 25, 'silence': 15}
+# local hours the household is awake, notifications are spread over them
+ACTIVE_HOURS = range(7, 24)
+
+
+def _created(rng: random.Random, day: date):
+    moment = datetime(day.year, day.month, day.day, rng.choice(ACTIVE_HOURS), rng.randrange(60), rng.randrange(60))
+    return moment.replace(tzinfo=timezone.utc)
+
+
+def _deleted(rng: random.Random, created: datetime):
+    return created + timedelta(minutes=rng.randrange(1, 60)) if rng.random() < DELETED_SHARE else None
+
+
+def user_records(users: int):
+    first_day = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    for i in range(users):
+        yield SEED_USER_BASE + i, SEED_HOUSEHOLD_ID, f'Seed{i}', 'History', False, first_day, None
+
+
+def notification_records(rng: random.Random, users: int, amount: int, days: int):
+    kinds = list(NOTIFICATION_WEIGHTS)
+    weights = list(NOTIFICATION_WEIGHTS.values())
+    # a few tenants do most of the housework
+    cum_weights = list(accumulate(1 / (i + 1) for i in range(users)))
+    first_day = date.today() - timedelta(days=days)
+    for _ in range(amount):
+        created = _created(rng, first_day + timedelta(days=rng.randrange(days + 1)))
+        user_id = SEED_USER_BASE + rng.choices(range(users), cum_weights=cum_weights)[0]
+        yield user_id, SEED_HOUSEHOLD_ID, rng.choices(kinds, weights=weights)[0], created, _deleted(rng, created)
+
+
+def party_records(rng: random.Random, users: int, days: int, share: float):
+    first_day = date.today() - timedelta(days=days)
+    now = datetime.now(timezone.utc)
+    # a year of upcoming parties on top of the history
+    for offset in range(days + 366):
+        if rng.random() >= share:
+            continue
+        party_date = first_day + timedelta(days=offset)
+        created = min(now, _created(rng, party_date - timedelta(days=rng.randrange(1, 30))))
+        user_id = SEED_USER_BASE + rng.randrange(users)
+        # a cancelled party frees the date, so it is booked once more
+        if rng.random() < DELETED_SHARE:
+            yield user_id, SEED_HOUSEHOLD_ID, party_date, rng.randrange(1, 51), rng.random() < 0.5, created, created
+        yield user_id, SEED_HOUSEHOLD_ID, party_date, rng.randrange(1, 51), rng.random() < 0.5, created, None
+
+
+async def copy_records(table: str, columns, records):
+    """
+    Streams records into the table with COPY, BATCH_SIZE rows per command.
+    :return: Returns int amount of copied rows.
+    """
+    copied = 0
+    async with db.acquire() as connection:
+        raw = connection.raw_connection
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                await raw.copy_records_to_table(table, records=batch, columns=columns)
+                copied += len(batch)
+                batch = []
+                print(f'  {table}: {copied} rows')
+        if batch:
+            await raw.copy_records_to_table(table, records=batch, columns=columns)
+            copied += len(batch)
+    return copied
+
+
+async def wipe_seeded():
+    for column in (Notification.user_id, Party.user_id, ActivityRollup.user_id, User.chat_id):
+        await column.table.delete().where(column.between(SEED_USER_BASE, SEED_USER_LIMIT - 1)).gino.status()
+    await db.status(
+        text('DELETE FROM notifications_archive WHERE user_id BETWEEN :first AND :last'),
+        first=SEED_USER_BASE, last=SEED_USER_LIMIT - 1,
+    )
+    await Household.delete.where(Household.chat_id == SEED_HOUSEHOLD_ID).gino.status()
+
+
+async def run(args):
+    rng = random.Random(SEED)
+    days = args.years * 365
+    await db.set_bind(get_database_url())
+    await migrate()
+    try:
+        started = time.perf_counter()
+        print('Removing rows of a previous seeding')
+        await wipe_seeded()
+
+        print('Copying rows')
+        await Household.create(chat_id=SEED_HOUSEHOLD_ID, title='Seeded history')
+        # every seeded month gets its partition, so nothing is routed to the default one
+        await create_live_partitions(date.today() - timedelta(days=days), date.today())
+        await copy_records(
+            User.__tablename__,
+            ['chat_id', 'household_id', 'firstname', 'lastname', 'is_admin', 'created', 'deleted'],
+            user_records(args.users),
+        )
+        await copy_records(
+            Notification.__tablename__,
+            ['user_id', 'household_id', 'notification_type', 'created', 'deleted'],
+            notification_records(rng, args.users, args.notifications, days),
+        )
+        await copy_records(
+            Party.__tablename__,
+            ['user_id', 'household_id', 'party_date', 'guests_amount', 'using_sofa', 'created', 'deleted'],
+            party_records(rng, args.users, days, args.party_share / 100),
+        )
+
+        print('Archiving old notifications')
+        await archive_notifications(**settings.notifications_retention)
+
+        print('Rebuilding the activity rollup')
+        await ActivityRollup.delete.where(ActivityRollup.household_id == SEED_HOUSEHOLD_ID).gino.status()
+        await backfill_activity(SEED_HOUSEHOLD_ID)
+        for table in (Household, User, Notification, Party, ActivityRollup):
+            await db.status(f'ANALYZE {table.__tablename__}')
+        await db.status('ANALYZE notifications_archive')
+        print(f'Done in {time.perf_counter() - started:.0f} s')
+    finally:
+        await db.pop_bind().close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk-loads a synthetic history for scale testing')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--notifications', type=int, default=2_000_000)
+    parser.add_argument('--years', type=int, default=5, help='years of history before today')
+    parser.add_argument('--party-share', type=float, default=15, help='percent of days with a party')
+    args = parser.parse_args()
+    if args.users > SEED_USER_LIMIT - SEED_USER_BASE:
+        parser.error(f'at most {SEED_USER_LIMIT - SEED_USER_BASE} users')
+    return args
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
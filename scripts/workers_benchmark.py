@@ -0,0 +1,72 @@
+"""
+Measures update throughput of the worker pool at 1, 2, 4 and 8 workers.
+Workers run a synthetic handler instead of the bot one: the update is parsed by aiogram,
+a calendar keyboard is built from scratch as CPU work and the DB and Bot API round trips
+are simulated with a sleep. The full bot is measured by the update-replay benchmark.
+
+Usage: python -m scripts.workers_benchmark [updates] [io latency ms]
+"""
+import asyncio
+import sys
+import time
+from datetime import date
+
+from aiogram import types
+
+from aiogramcalendar import _build_calendar, _month_layout
+from moon_house_bot.workers import WorkerPool
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+IO_LATENCY = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000
+USERS = 1000
+WORKERS = (1, 2, 4, 8)
+
+
+async def _startup():
+    pass
+
+
+async def _process(data: dict):
+    update = types.Update(**data)
+    _build_calendar(_month_layout.__wrapped__(date.today().year, update.message.message_id % 12 + 1, date.today()))
+    await asyncio.sleep(IO_LATENCY)
+
+
+async def _shutdown():
+    pass
+
+
+def synthetic_hooks(index: int):
+    return _startup, _process, _shutdown
+
+
+def synthetic_update(update_id: int):
+    user = {'id': update_id % USERS + 1, 'is_bot': False, 'first_name': 'Bench'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': dict(user, type='private'),
+            'from': user,
+            'text': 'Выкинуть мусор 🗑',
+        },
+    }
+
+
+def measure(workers: int):
+    pool = WorkerPool(workers, target='scripts.workers_benchmark:synthetic_hooks')
+    pool.start()
+    pool.wait_ready()
+    updates = [synthetic_update(i) for i in range(UPDATES)]
+    started = time.perf_counter()
+    for update in updates:
+        pool.dispatch(update)
+    pool.stop()
+    return UPDATES / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    print(f'{UPDATES} updates, {IO_LATENCY * 1000:.0f} ms simulated IO per update')
+    for amount in WORKERS:
+        print(f'{amount} workers: {measure(amount):8.0f} updates/sec')
@@ -0,0 +1,4 @@
+import os
+
+# config needs a bot token, every module reads settings on import
+os.environ.setdefault('TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
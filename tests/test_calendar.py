@@ -0,0 +1,21 @@
+from datetime import date
+
+from aiogramcalendar import BOOKED_DAY_TEXT, _month_layout, create_calendar
+
+
+def day_texts(keyboard):
+    # the month and week day rows come first, the rollback row last
+    return [button.text for row in keyboard.inline_keyboard[2:-1] for button in row]
+
+
+def test_bookings_of_different_households_share_the_cached_month():
+    today = date.today()
+    year, month = today.year + 1, 1
+    _month_layout.cache_clear()
+    first = create_calendar(year, month, booked=1 << 10)
+    second = create_calendar(year, month, booked=1 << 20)
+    assert _month_layout.cache_info().hits == 1
+    assert day_texts(first).count(BOOKED_DAY_TEXT) == 1
+    assert '10' not in day_texts(first) and '20' in day_texts(first)
+    assert '10' in day_texts(second) and '20' not in day_texts(second)
+    assert '10' in day_texts(create_calendar(year, month))
@@ -0,0 +1,23 @@
+import pytest
+
+from config import settings
+from moon_house_bot import app
+from moon_house_bot.database import pool_stats
+
+
+@pytest.fixture
+def waiting():
+    yield
+    pool_stats.waiting = 0
+
+
+def test_no_shedding_while_callers_wait_for_a_free_connection(waiting):
+    limit = int(settings.load_shedding.pool_waiting_ratio * settings.database_pool.max_size)
+    for waiting_callers in (0, 1, limit):
+        pool_stats.waiting = waiting_callers
+        assert not app.is_overloaded()
+
+
+def test_shedding_once_the_pool_is_saturated(waiting):
+    pool_stats.waiting = int(settings.load_shedding.pool_waiting_ratio * settings.database_pool.max_size) + 1
+    assert app.is_overloaded()
@@ -0,0 +1,18 @@
+import json
+
+from moon_house_bot.broadcast import Broadcast
+from moon_house_bot.database import User
+from moon_house_bot.members import MemberCache
+
+
+def test_member_changed_in_another_process_is_dropped():
+    broadcast = Broadcast()
+    members = MemberCache(broadcast)
+    members.set(1, User(chat_id=1, household_id=-1, firstname='Tenant'))
+    members.set(2, None)
+
+    for chat_id in (1, 2):
+        payload = json.dumps({'origin': 'another process', 'data': chat_id})
+        broadcast._dispatch(None, 0, MemberCache.channel, payload)
+
+    assert members.stats['size'] == 0
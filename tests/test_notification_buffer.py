@@ -0,0 +1,50 @@
+import asyncio
+
+from moon_house_bot.database import activity
+from moon_house_bot.database.activity import NotificationBuffer
+from moon_house_bot.metrics import dropped_notifications
+
+
+class FlakyWriter:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.written = []
+
+    async def __call__(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        self.written.extend(batch)
+
+
+def test_failed_batch_is_written_by_a_later_flush(monkeypatch):
+    writer = FlakyWriter(failures=1)
+    monkeypatch.setattr(activity, '_write_notifications', writer)
+
+    async def run():
+        buffer = NotificationBuffer(enabled=True, max_size=10, max_delay=60, retry_delay=60)
+        await buffer.create(1, -1, 'trash')
+        await buffer.create(2, -1, 'silence')
+        await buffer.flush()
+        assert writer.written == []
+        await buffer.create(3, -1, 'trash')
+        await buffer.flush()
+        await buffer.close()
+
+    asyncio.run(run())
+    assert [n.user_id for n in writer.written] == [1, 2, 3]
+
+
+def test_batch_is_dropped_and_counted_after_max_attempts(monkeypatch):
+    writer = FlakyWriter(failures=3)
+    monkeypatch.setattr(activity, '_write_notifications', writer)
+    dropped_notifications.clear()
+
+    async def run():
+        buffer = NotificationBuffer(enabled=True, max_size=10, max_delay=60, max_attempts=3, retry_delay=60)
+        await buffer.create(1, -1, 'trash')
+        await buffer.close()
+
+    asyncio.run(run())
+    assert writer.written == []
+    assert dropped_notifications._values == {(): 1}
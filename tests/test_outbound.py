@@ -0,0 +1,41 @@
+import asyncio
+
+from aiogram.utils.exceptions import RetryAfter
+
+from moon_house_bot.outbound import OutboundDispatcher
+
+
+class FlakyBot:
+    def __init__(self):
+        self.uploaded = []
+
+    async def send_document(self, chat_id, document):
+        # aiohttp reads the stream to the end and closes it, whatever the response is
+        data = document.file.read()
+        document.file.close()
+        self.uploaded.append(data)
+        if len(self.uploaded) == 1:
+            raise RetryAfter(0)
+        return data
+
+
+def test_retried_upload_sends_the_whole_document():
+    async def run():
+        bot = FlakyBot()
+        outbound = OutboundDispatcher(bot, workers=1, private_chat_interval=0)
+        await outbound.start()
+        try:
+            result = await asyncio.wait_for(outbound.send_document(1, b'a,b\r\n1,2\r\n', 'history_1.csv'), 5)
+        finally:
+            await outbound.close()
+        return bot, outbound, result
+
+    bot, outbound, result = asyncio.run(run())
+    assert bot.uploaded == [b'a,b\r\n1,2\r\n', b'a,b\r\n1,2\r\n']
+    assert result == b'a,b\r\n1,2\r\n'
+    assert outbound.retried == 1
+
+
+def test_global_rate_is_shared_by_the_processes():
+    outbound = OutboundDispatcher(FlakyBot(), global_rate=30, processes=4)
+    assert outbound.global_rate == 7.5
@@ -0,0 +1,19 @@
+import re
+from datetime import date
+
+from sqlalchemy import text
+
+from moon_house_bot.database.partitions import month_start, partition_sql
+
+
+def test_partition_ddl_has_no_parameters():
+    sql = partition_sql('notifications_p202612', 'notifications', date(2026, 12, 1), date(2027, 1, 1))
+    assert sql.endswith("FROM ('2026-12-01 00:00:00+00') TO ('2027-01-01 00:00:00+00')")
+    # Postgres rejects parameters in DDL, neither asyncpg nor SQLAlchemy placeholders may appear
+    assert not re.search(r'\$\d|%\(|\?', sql)
+    assert not text(sql).compile().params
+
+
+def test_month_start_crosses_years():
+    assert month_start(date(2026, 12, 31), 1) == date(2027, 1, 1)
+    assert month_start(date(2027, 1, 15), -3) == date(2026, 10, 1)
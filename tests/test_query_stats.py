@@ -0,0 +1,23 @@
+import pytest
+
+from moon_house_bot.database.queries import QueryStats
+
+ANALYZE = 'EXPLAIN (ANALYZE, BUFFERS)'
+
+
+@pytest.mark.parametrize('query, explain', [
+    ('SELECT users.chat_id FROM users WHERE users.household_id = $1', ANALYZE),
+    ('WITH recent AS (SELECT * FROM notifications) SELECT count(*) FROM recent', ANALYZE),
+    ('SELECT fsm_states.updated FROM fsm_states', ANALYZE),
+    ('INSERT INTO activity_rollup (user_id, amount) VALUES ($1, $2) '
+     'ON CONFLICT (user_id) DO UPDATE SET amount = activity_rollup.amount + excluded.amount', 'EXPLAIN'),
+    ('UPDATE parties SET deleted = $1 WHERE parties.id = $2', 'EXPLAIN'),
+    ('WITH moved AS (DELETE FROM notifications RETURNING *) INSERT INTO notifications_archive SELECT * FROM moved',
+     'EXPLAIN'),
+    ('SELECT * FROM parties WHERE id = $1 FOR UPDATE', 'EXPLAIN'),
+    ('SELECT * FROM parties WHERE id = $1 FOR KEY SHARE', 'EXPLAIN'),
+    ('SELECT pg_advisory_xact_lock($1)', None),
+    ('CREATE INDEX ix ON users (household_id)', None),
+])
+def test_writes_are_not_executed_again(query, explain):
+    assert QueryStats.explain_command(query) == explain